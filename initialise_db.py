@@ -1,261 +1,249 @@
-from project import db, create_app, models
-from project.models import Restaurant, MenuItem
+import argparse
+import itertools
+import logging
+import operator
+import os
+import time
+
+from sqlalchemy import delete, exists, func, inspect
+from sqlalchemy.exc import IntegrityError
+from werkzeug import security
+
+from project import counters, db, create_app, models
+from project.main import COURSES
+from project.models import Restaurant, MenuItem, Comment, User, parse_price
+from project.search import create_search_index, drop_search_index
+
+
+SAMPLE_MENUS = [
+    ('Urban Burger', [
+        ('French Fries', 'with garlic and parmesan', '$2.99', 'Appetizer'),
+        ('Chicken Burger', 'Juicy grilled chicken patty with tomato mayo and lettuce', '$5.50', 'Entree'),
+        ('Chocolate Cake', 'fresh baked and served with ice cream', '$3.99', 'Dessert'),
+        ('Sirloin Burger', 'Made with grade A beef', '$7.99', 'Entree'),
+        ('Root Beer', '16oz of refreshing goodness', '$1.99', 'Beverage'),
+        ('Iced Tea', 'with Lemon', '$.99', 'Beverage'),
+        ('Grilled Cheese Sandwich', 'On texas toast with American Cheese', '$3.49', 'Entree'),
+        ('Veggie Burger', 'Made with freshest of ingredients and home grown spices', '$5.99', 'Entree'),
+    ]),
+    ('Super Stir Fry', [
+        ('Chicken Stir Fry', 'with your choice of noodles vegetables and sauces', '$7.99', 'Entree'),
+        ('Peking Duck', ' a famous duck dish from Beijing[1] that has been prepared since the imperial era. The meat is prized for its thin, crisp skin, with authentic versions of the dish serving mostly the skin and little meat, sliced in front of the diners by the cook', '$25', 'Entree'),
+        ('Spicy Tuna Roll', '', '', ''),
+        ('Nepali Momo ', '', '', ''),
+        ('Beef Noodle Soup', '', '', ''),
+        ('Ramen', '', '', ''),
+    ]),
+    ('Panda Garden', [
+        ('Pho', 'a Vietnamese noodle soup consisting of broth, linguine-shaped rice noodles called banh pho, a few herbs, and meat.', '', ''),
+        ('Chinese Dumplings', 'a common Chinese dumpling which generally consists of minced meat and finely chopped vegetables wrapped into a piece of dough skin. The skin can be either thin and elastic or thicker.', '', ''),
+        ('Gyoza', 'The most prominent differences between Japanese-style gyoza and Chinese-style jiaozi are the rich garlic flavor, which is less noticeable in the Chinese version, the light seasoning of Japanese gyoza with salt and soy sauce, and the fact that gyoza wrappers are much thinner', '', ''),
+        ('Stinky Tofu', 'Taiwanese dish, deep fried fermented tofu served with pickled cabbage.', '', ''),
+    ]),
+    ('Thyme for That Vegetarian Cuisine ', [
+        ('Tres Leches Cake', 'Rich, luscious sponge cake soaked in sweet milk and topped with vanilla bean whipped cream and strawberries.', '', ''),
+        ('Mushroom risotto', 'Portabello mushrooms in a creamy risotto', '', ''),
+        ('Honey Boba Shaved Snow', 'Milk snow layered with honey boba, jasmine tea jelly, grass jelly, caramel, cream, and freshly made mochi', '', ''),
+        ('Cauliflower Manchurian', 'Golden fried cauliflower florets in a midly spiced soya,garlic sauce cooked with fresh cilantro, celery, chilies,ginger & green onions', '', ''),
+        ('Aloo Gobi Burrito', 'Vegan goodness. Burrito filled with rice, garbanzo beans, curry sauce, potatoes (aloo), fried cauliflower (gobi) and chutney. Nom Nom', '', ''),
+    ]),
+    ("Tony's Bistro ", [
+        ('Shellfish Tower', '', '', ''),
+        ('Chicken and Rice', '', '', ''),
+        ("Mom's Spaghetti", '', '', ''),
+        ("Choc Full O' Mint (Smitten's Fresh Mint Chip ice cream)", '', '', ''),
+        ('Tonkatsu Ramen', 'Noodles in a delicious pork-based broth with a soft-boiled egg', '', ''),
+    ]),
+    ("Andala's", [
+        ('Lamb Curry', 'Slow cook that thang in a pool of tomatoes, onions and alllll those tasty Indian spices. Mmmm.', '', ''),
+        ('Chicken Marsala', 'Chicken cooked in Marsala wine sauce with mushrooms', '', ''),
+        ('Potstickers', 'Delicious chicken and veggies encapsulated in fried dough.', '', ''),
+        ('Nigiri SamplerMaguro, Sake, Hamachi, Unagi, Uni, TORO!', '', '', ''),
+    ]),
+    ("Auntie Ann's Diner ", [
+        ('Chicken Fried Steak', 'Fresh battered sirloin steak fried and smothered with cream gravy', '$8.99', 'Entree'),
+        ('Boysenberry Sorbet', 'An unsettlingly huge amount of ripe berries turned into frozen (and seedless) awesomeness', '', ''),
+        ('Broiled salmon', 'Salmon fillet marinated with fresh herbs and broiled hot & fast', '', ''),
+        ('Morels on toast (seasonal)', 'Wild morel mushrooms fried in butter, served on herbed toast slices', '', ''),
+        ('Tandoori Chicken', 'Chicken marinated in yoghurt and seasoned with a spicy mix(chilli, tamarind among others) and slow cooked in a cylindrical clay or metal oven which gets its heat from burning charcoal.', '', ''),
+    ]),
+    ('Cocina Y Amor ', [
+        ('Super Burrito Al Pastor', 'Marinated Pork, Rice, Beans, Avocado, Cilantro, Salsa, Tortilla', '', ''),
+        ('Cachapa', 'Golden brown, corn-based venezuelan pancake; usually stuffed with queso telita or queso de mano, and possibly lechon. ', '', ''),
+    ]),
+]
 
 
 def populate_db():
-    # Menu for UrbanBurger
-    restaurant1 = Restaurant(name="Urban Burger")
-
+    # Add all the sample restaurants and their menus in a single transaction
     session = db.session()
 
-    session.add(restaurant1)
-    session.commit()
-
-    menuItem1 = MenuItem(name="French Fries", description="with garlic and parmesan", price="$2.99", course="Appetizer",
-                         restaurant=restaurant1)
-    session.add(menuItem1)
-    session.commit()
-
-    menuItem2 = MenuItem(name="Chicken Burger", description="Juicy grilled chicken patty with tomato mayo and lettuce",
-                         price="$5.50", course="Entree", restaurant=restaurant1)
-    session.add(menuItem2)
-    session.commit()
-
-    menuItem3 = MenuItem(name="Chocolate Cake", description="fresh baked and served with ice cream", price="$3.99",
-                         course="Dessert", restaurant=restaurant1)
-    session.add(menuItem3)
-    session.commit()
-
-    menuItem4 = MenuItem(name="Sirloin Burger", description="Made with grade A beef", price="$7.99", course="Entree",
-                         restaurant=restaurant1)
-    session.add(menuItem4)
-    session.commit()
-
-    menuItem5 = MenuItem(name="Root Beer", description="16oz of refreshing goodness", price="$1.99", course="Beverage",
-                         restaurant=restaurant1)
-    session.add(menuItem5)
-    session.commit()
-
-    menuItem6 = MenuItem(name="Iced Tea", description="with Lemon", price="$.99", course="Beverage",
-                         restaurant=restaurant1)
-    session.add(menuItem6)
-    session.commit()
-
-    menuItem7 = MenuItem(name="Grilled Cheese Sandwich", description="On texas toast with American Cheese",
-                         price="$3.49", course="Entree", restaurant=restaurant1)
-    session.add(menuItem7)
-    session.commit()
-
-    menuItem8 = MenuItem(name="Veggie Burger", description="Made with freshest of ingredients and home grown spices",
-                         price="$5.99", course="Entree", restaurant=restaurant1)
-    session.add(menuItem8)
-    session.commit()
-
-    # Menu for Super Stir Fry
-    restaurant2 = Restaurant(name="Super Stir Fry")
-    session.add(restaurant2)
-    session.commit()
-
-    menuItem1 = MenuItem(name="Chicken Stir Fry", description="with your choice of noodles vegetables and sauces",
-                         price="$7.99", course="Entree", restaurant=restaurant2)
-    session.add(menuItem1)
-    session.commit()
-
-    menuItem2 = MenuItem(name="Peking Duck",
-                         description=" a famous duck dish from Beijing[1] that has been prepared since the imperial era. The meat is prized for its thin, crisp skin, with authentic versions of the dish serving mostly the skin and little meat, sliced in front of the diners by the cook",
-                         price="$25", course="Entree", restaurant=restaurant2)
-    session.add(menuItem2)
-    session.commit()
-
-    menuItem3 = MenuItem(name="Spicy Tuna Roll", description="", price="", course="", restaurant=restaurant2)
-    session.add(menuItem3)
-    session.commit()
-
-    menuItem4 = MenuItem(name="Nepali Momo ", description="", price="", course="", restaurant=restaurant2)
-    session.add(menuItem4)
-    session.commit()
-
-    menuItem5 = MenuItem(name="Beef Noodle Soup", description="", price="", course="", restaurant=restaurant2)
-    session.add(menuItem5)
-    session.commit()
-
-    menuItem6 = MenuItem(name="Ramen", description="", price="", course="", restaurant=restaurant2)
-    session.add(menuItem6)
-    session.commit()
-
-    # Menu for Panda Garden
-    restaurant1 = Restaurant(name="Panda Garden")
+    for name, items in SAMPLE_MENUS:
+        restaurant = Restaurant(name=name)
+        session.add(restaurant)
+        session.add_all([MenuItem(name=item_name, description=description, price=price, course=course,
+                                  restaurant=restaurant)
+                         for item_name, description, price, course in items])
 
-    session.add(restaurant1)
     session.commit()
+    counters.rebuild()
 
-    menuItem1 = MenuItem(name="Pho",
-                         description="a Vietnamese noodle soup consisting of broth, linguine-shaped rice noodles called banh pho, a few herbs, and meat.",
-                         price="", course="", restaurant=restaurant1)
-    session.add(menuItem1)
-    session.commit()
+    print("added menu items!")
 
-    menuItem2 = MenuItem(name="Chinese Dumplings",
-                         description="a common Chinese dumpling which generally consists of minced meat and finely chopped vegetables wrapped into a piece of dough skin. The skin can be either thin and elastic or thicker.",
-                         price="", course="", restaurant=restaurant1)
-    session.add(menuItem2)
-    session.commit()
 
-    menuItem3 = MenuItem(name="Gyoza",
-                         description="The most prominent differences between Japanese-style gyoza and Chinese-style jiaozi are the rich garlic flavor, which is less noticeable in the Chinese version, the light seasoning of Japanese gyoza with salt and soy sauce, and the fact that gyoza wrappers are much thinner",
-                         price="", course="", restaurant=restaurant1)
-    session.add(menuItem3)
-    session.commit()
+def batches(rows, batch_size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
-    menuItem4 = MenuItem(name="Stinky Tofu",
-                         description="Taiwanese dish, deep fried fermented tofu served with pickled cabbage.", price="",
-                         course="", restaurant=restaurant1)
-    session.add(menuItem4)
-    session.commit()
 
-    # Menu for Thyme for that
-    restaurant1 = Restaurant(name="Thyme for That Vegetarian Cuisine ")
-    session.add(restaurant1)
-    session.commit()
+def bulk_insert(model, rows, batch_size):
+    """
+    Insert dicts of column values with the driver's executemany, skipping SQLAlchemy's per-row parameter
+    processing which otherwise takes most of the time.
+    """
+    connection = db.session.connection()
+    rows = iter(rows)
+    first = next(rows, None)
+    if first is None:
+        return
 
-    menuItem1 = MenuItem(name="Tres Leches Cake",
-                         description="Rich, luscious sponge cake soaked in sweet milk and topped with vanilla bean whipped cream and strawberries.",
-                         price="", course="", restaurant=restaurant1)
-    session.add(menuItem1)
-    session.commit()
+    compiled = model.__table__.insert().compile(dialect=connection.dialect, column_keys=list(first))
+    values = operator.itemgetter(*compiled.positiontup)
 
-    menuItem2 = MenuItem(name="Mushroom risotto", description="Portabello mushrooms in a creamy risotto", price="",
-                         course="", restaurant=restaurant1)
-    session.add(menuItem2)
-    session.commit()
+    for batch in batches(itertools.chain([first], rows), batch_size):
+        connection.exec_driver_sql(str(compiled), [values(row) for row in batch])
 
-    menuItem3 = MenuItem(name="Honey Boba Shaved Snow",
-                         description="Milk snow layered with honey boba, jasmine tea jelly, grass jelly, caramel, cream, and freshly made mochi",
-                         price="", course="", restaurant=restaurant1)
-    session.add(menuItem3)
-    session.commit()
 
-    menuItem4 = MenuItem(name="Cauliflower Manchurian",
-                         description="Golden fried cauliflower florets in a midly spiced soya,garlic sauce cooked with fresh cilantro, celery, chilies,ginger & green onions",
-                         price="", course="", restaurant=restaurant1)
-    session.add(menuItem4)
-    session.commit()
+def next_id(model):
+    return (db.session.query(func.max(model.id)).scalar() or 0) + 1
 
-    menuItem5 = MenuItem(name="Aloo Gobi Burrito",
-                         description="Vegan goodness. Burrito filled with rice, garbanzo beans, curry sauce, potatoes (aloo), fried cauliflower (gobi) and chutney. Nom Nom",
-                         price="", course="", restaurant=restaurant1)
-    session.add(menuItem5)
-    session.commit()
 
-    # Menu for Tony's Bistro
-    restaurant1 = Restaurant(name="Tony\'s Bistro ")
-    session.add(restaurant1)
-    session.commit()
+def generate_synthetic_data(restaurants, items, comments, users, batch_size=10000):
+    """
+    Add generated restaurants, each with the given number of menu items and comments, and a pool of users who
+    write the comments. Rows are inserted with executemany in batches, all in one transaction.
+    Every synthetic user has the password "password".
+    """
+    session = db.session()
 
-    menuItem1 = MenuItem(name="Shellfish Tower", description="", price="", course="", restaurant=restaurant1)
-    session.add(menuItem1)
-    session.commit()
+    first_user = next_id(User)
+    first_restaurant = next_id(Restaurant)
+    users = max(users, 1)
+
+    # Hashing is deliberately slow, so every user shares one hash
+    password = security.generate_password_hash("password", method="scrypt")
+
+    user_rows = ({'id': first_user + n, 'name': f"user{first_user + n}", 'email': f"user{first_user + n}@example.com",
+                  'password': password, 'permission': 0} for n in range(users))
+    now = int(time.time())
+    restaurant_rows = ({'id': first_restaurant + n, 'name': f"Restaurant {first_restaurant + n}", 'item_count': items,
+                        'comment_count': comments, 'updated_at': now} for n in range(restaurants))
+    item_rows = ({'name': f"Item {i}", 'description': f"Synthetic menu item {i}", 'price_cents': (i % 50) * 100 + 99,
+                  'course': COURSES[i % len(COURSES)], 'restaurant_id': first_restaurant + n}
+                 for n in range(restaurants) for i in range(items))
+    comment_rows = ({'title': f"Comment {c}", 'description': f"Synthetic comment {c}", 'username': c % 4 != 0,
+                     'restaurantid': first_restaurant + n, 'userid': first_user + (n * comments + c) % users}
+                    for n in range(restaurants) for c in range(comments))
 
-    menuItem2 = MenuItem(name="Chicken and Rice", description="", price="", course="", restaurant=restaurant1)
-    session.add(menuItem2)
-    session.commit()
+    # Indexing for search row by row through the triggers would take most of the time, so the search index
+    # is dropped and then rebuilt from all rows in one statement
+    drop_search_index(db.metadata, session.connection())
 
-    menuItem3 = MenuItem(name="Mom's Spaghetti", description="", price="", course="", restaurant=restaurant1)
-    session.add(menuItem3)
-    session.commit()
+    for model, rows in ((User, user_rows), (Restaurant, restaurant_rows), (MenuItem, item_rows),
+                        (Comment, comment_rows)):
+        bulk_insert(model, rows, batch_size)
 
-    menuItem4 = MenuItem(name="Choc Full O\' Mint (Smitten\'s Fresh Mint Chip ice cream)", description="", price="",
-                         course="", restaurant=restaurant1)
-    session.add(menuItem4)
+    create_search_index(db.metadata, session.connection())
     session.commit()
 
-    menuItem5 = MenuItem(name="Tonkatsu Ramen",
-                         description="Noodles in a delicious pork-based broth with a soft-boiled egg", price="",
-                         course="", restaurant=restaurant1)
-    session.add(menuItem5)
-    session.commit()
+    print(f"added {restaurants} restaurants with {restaurants * items} menu items, "
+          f"{restaurants * comments} comments and {users} users!")
 
-    # Menu for Andala's
-    restaurant1 = Restaurant(name="Andala\'s")
-    session.add(restaurant1)
-    session.commit()
-
-    menuItem1 = MenuItem(name="Lamb Curry",
-                         description="Slow cook that thang in a pool of tomatoes, onions and alllll those tasty Indian spices. Mmmm.",
-                         price="", course="", restaurant=restaurant1)
-    session.add(menuItem1)
-    session.commit()
 
-    menuItem2 = MenuItem(name="Chicken Marsala", description="Chicken cooked in Marsala wine sauce with mushrooms",
-                         price="", course="", restaurant=restaurant1)
-    session.add(menuItem2)
-    session.commit()
+def migrate_prices(batch_size=10000):
+    """Move menu item prices from the old text column to integer cents, then drop the text column"""
+    connection = db.session.connection()
+    columns = {column['name'] for column in inspect(connection).get_columns('menu_item')}
+    if 'price' not in columns:
+        return
 
-    menuItem3 = MenuItem(name="Potstickers", description="Delicious chicken and veggies encapsulated in fried dough.",
-                         price="", course="", restaurant=restaurant1)
-    session.add(menuItem3)
-    session.commit()
+    if 'price_cents' not in columns:
+        connection.exec_driver_sql("ALTER TABLE menu_item ADD COLUMN price_cents INTEGER")
 
-    menuItem4 = MenuItem(name="Nigiri SamplerMaguro, Sake, Hamachi, Unagi, Uni, TORO!", description="", price="",
-                         course="", restaurant=restaurant1)
-    session.add(menuItem4)
-    session.commit()
+    rows = connection.exec_driver_sql("SELECT id, price FROM menu_item WHERE price IS NOT NULL AND price != ''")
+    updates = []
+    for item_id, price in rows:
+        try:
+            updates.append((parse_price(price), item_id))
+        except ValueError:
+            logging.warning(f"Menu item {item_id} has an invalid price {price!r}, it is left without a price")
 
-    # Menu for Auntie Ann's
-    restaurant1 = Restaurant(name="Auntie Ann\'s Diner ")
-    session.add(restaurant1)
-    session.commit()
+    for batch in batches(updates, batch_size):
+        connection.exec_driver_sql("UPDATE menu_item SET price_cents = ? WHERE id = ?", batch)
 
-    menuItem9 = MenuItem(name="Chicken Fried Steak",
-                         description="Fresh battered sirloin steak fried and smothered with cream gravy", price="$8.99",
-                         course="Entree", restaurant=restaurant1)
-    session.add(menuItem9)
-    session.commit()
+    connection.exec_driver_sql("ALTER TABLE menu_item DROP COLUMN price")
+    db.session.commit()
 
-    menuItem1 = MenuItem(name="Boysenberry Sorbet",
-                         description="An unsettlingly huge amount of ripe berries turned into frozen (and seedless) awesomeness",
-                         price="", course="", restaurant=restaurant1)
+    print(f"converted {len(updates)} menu item prices to cents!")
 
-    session.add(menuItem1)
-    session.commit()
 
-    menuItem2 = MenuItem(name="Broiled salmon",
-                         description="Salmon fillet marinated with fresh herbs and broiled hot & fast", price="",
-                         course="", restaurant=restaurant1)
-    session.add(menuItem2)
-    session.commit()
+def migrate_restaurant_counters():
+    """Add the denormalised counter columns to the restaurant table and count the existing rows"""
+    connection = db.session.connection()
+    columns = {column['name'] for column in inspect(connection).get_columns('restaurant')}
+    if 'item_count' in columns:
+        return
 
-    menuItem3 = MenuItem(name="Morels on toast (seasonal)",
-                         description="Wild morel mushrooms fried in butter, served on herbed toast slices", price="",
-                         course="", restaurant=restaurant1)
-    session.add(menuItem3)
-    session.commit()
+    connection.exec_driver_sql("ALTER TABLE restaurant ADD COLUMN item_count INTEGER DEFAULT '0' NOT NULL")
+    connection.exec_driver_sql("ALTER TABLE restaurant ADD COLUMN comment_count INTEGER DEFAULT '0' NOT NULL")
+    connection.exec_driver_sql("ALTER TABLE restaurant ADD COLUMN updated_at INTEGER")
+    print(f"counted the items and comments of {counters.rebuild()} restaurants!")
 
-    menuItem4 = MenuItem(name="Tandoori Chicken",
-                         description="Chicken marinated in yoghurt and seasoned with a spicy mix(chilli, tamarind among others) and slow cooked in a cylindrical clay or metal oven which gets its heat from burning charcoal.",
-                         price="", course="", restaurant=restaurant1)
-    session.add(menuItem4)
-    session.commit()
 
-    # Menu for Cocina Y Amor
-    restaurant1 = Restaurant(name="Cocina Y Amor ")
-    session.add(restaurant1)
-    session.commit()
+def migrate_db():
+    """
+    Bring an existing database up to date with the models: create missing tables and indexes, and convert
+    columns whose type changed. Safe to run any number of times.
+    """
+    db.create_all()
+    migrate_prices()
+    migrate_restaurant_counters()
 
-    menuItem1 = MenuItem(name="Super Burrito Al Pastor",
-                         description="Marinated Pork, Rice, Beans, Avocado, Cilantro, Salsa, Tortilla", price="",
-                         course="", restaurant=restaurant1)
-    session.add(menuItem1)
-    session.commit()
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            try:
+                index.create(db.engine, checkfirst=True)
+            except IntegrityError as e:
+                # A unique index can't be created while the table holds duplicates
+                logging.warning(f"Could not create index {index.name}, remove the duplicate rows and try again: {e}")
 
-    menuItem2 = MenuItem(name="Cachapa",
-                         description="Golden brown, corn-based venezuelan pancake; usually stuffed with queso telita or queso de mano, and possibly lechon. ",
-                         price="", course="", restaurant=restaurant1)
+    print("database migrated!")
 
-    session.add(menuItem2)
-    session.commit()
 
-    print("added menu items!")
+def compact_db():
+    """
+    Delete the menu items and comments left behind by restaurants deleted before deletion removed them too,
+    then VACUUM to return the freed pages to the file system.
+    """
+    orphans = {
+        'menu items': delete(MenuItem).where(~exists().where(Restaurant.id == MenuItem.restaurant_id)),
+        'comments': delete(Comment).where(~exists().where(Restaurant.id == Comment.restaurantid)),
+    }
+    for name, statement in orphans.items():
+        print(f"deleted {db.session.execute(statement).rowcount} orphaned {name}!")
+    db.session.commit()
+
+    # VACUUM can't run inside a transaction
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        connection.exec_driver_sql("VACUUM")
+
+    print("database compacted!")
 
 
 def gen_secret_key():
@@ -265,9 +253,34 @@ def gen_secret_key():
 
 
 if __name__ == '__main__':
-    gen_secret_key()
+    parser = argparse.ArgumentParser(description="Create and populate the restaurant database.")
+    parser.add_argument('--migrate', action='store_true',
+                        help="upgrade the schema of an existing database instead of creating a new one")
+    parser.add_argument('--compact', action='store_true',
+                        help="delete orphaned menu items and comments from an existing database and VACUUM it")
+    parser.add_argument('--synthetic', type=int, metavar='N',
+                        help="add N generated restaurants for load testing instead of the sample data")
+    parser.add_argument('--items', type=int, default=20, metavar='M', help="menu items per generated restaurant")
+    parser.add_argument('--comments', type=int, default=5, metavar='K', help="comments per generated restaurant")
+    parser.add_argument('--users', type=int, default=100, help="number of generated users writing the comments")
+    args = parser.parse_args()
+
+    # Generated data may be added to a live site, keep its key so nobody is logged out
+    if args.synthetic is not None:
+        if not os.path.exists("secret_key"):
+            gen_secret_key()
+    elif not (args.migrate or args.compact):
+        gen_secret_key()
 
     app = create_app()
     with app.app_context():
-        db.create_all()
-        populate_db()
+        if args.migrate:
+            migrate_db()
+        elif args.compact:
+            compact_db()
+        elif args.synthetic is not None:
+            db.create_all()
+            generate_synthetic_data(args.synthetic, args.items, args.comments, args.users)
+        else:
+            db.create_all()
+            populate_db()
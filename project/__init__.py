@@ -6,15 +6,52 @@ from flask_sqlalchemy import SQLAlchemy
 # init SQLAlchemy so we can use it later in our models
 db = SQLAlchemy()
 
-def create_app():
+def create_app(test_config=None):
     app = Flask(__name__)
 
-    with open("secret_key", "r") as secret_file:
-        app.secret_key = secret_file.readline()
-
     app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///restaurantmenu.db'
 
-    db.init_app(app)
+    # Any setting can be overridden from the environment, e.g. FLASK_SQLALCHEMY_DATABASE_URI=sqlite:////fast/menu.db
+    app.config.from_prefixed_env()
+
+    if test_config is not None:
+        app.config.update(test_config)
+
+    if app.secret_key is None:
+        with open("secret_key", "r") as secret_file:
+            app.secret_key = secret_file.readline()
+
+    # cache invalidations shared by the workers of the pre-fork server
+    from .bus import invalidation_bus
+    invalidation_bus.init_app(app)
+
+    # SQLAlchemy with the connection pool and SQLite pragmas from the database profile
+    from . import database
+    database.init_app(app)
+
+    # in-memory session token cache with batched "last used" updates
+    from .sessions import session_cache
+    session_cache.init_app(app)
+
+    # worker processes for scrypt password hashing
+    from .hashing import password_hasher
+    password_hasher.init_app(app)
+
+    # token bucket limits on sign in, sign up and 2FA attempts
+    from .ratelimit import rate_limiter
+    rate_limiter.init_app(app)
+
+    # rebuild-counters command for the denormalised restaurant counters
+    from . import counters
+    counters.init_app(app)
+
+    # compiled templates kept on disk between server starts
+    from . import templating
+    templating.init_app(app)
+
+    # opt-in request timing, SQL and template instrumentation served from /metrics
+    from . import metrics
+    metrics.init_app(app)
 
     # blueprint for auth routes in our app
     from .json import json as json_blueprint
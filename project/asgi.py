@@ -0,0 +1,207 @@
+"""
+The read-only JSON API as an asynchronous ASGI application, for serving many slow or long polling clients without
+tying up the threads of the WSGI site. It answers the same URLs as the json blueprint with the same responses,
+from the same database, and can be run next to the site with any ASGI server, for example:
+
+    uvicorn --factory project.asgi:create_asgi_app --port 8001
+
+Requires aiosqlite. Settings are read like create_app() reads them, including FLASK_ prefixed environment variables.
+"""
+import json as pyjs
+import os
+from urllib.parse import parse_qs
+
+from flask import Flask
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from werkzeug.exceptions import HTTPException, MethodNotAllowed
+from werkzeug.routing import Map, Rule
+
+from .database import DEFAULT_SQLITE_PRAGMAS, is_sqlite_file, listen_sqlite_pragmas
+from .json import STREAM_BATCH_SIZE, MENU_ITEM, RESTAURANTS_FIRST_PAGE, RESTAURANTS_FIRST_PAGE_PROBE, \
+    RESTAURANTS_PAGE, RESTAURANTS_PAGE_PROBE, menu_page_query
+from .pagination import clamp_page_size, encode_cursor, parse_cursor
+
+url_map = Map([
+    Rule('/restaurant/JSON', endpoint='restaurantsJSON', methods=['GET', 'HEAD']),
+    Rule('/restaurant/<int:restaurant_id>/menu/JSON', endpoint='restaurantMenuJSON', methods=['GET', 'HEAD']),
+    Rule('/restaurant/<int:restaurant_id>/menu/<int:menu_id>/JSON', endpoint='menuItemJSON', methods=['GET', 'HEAD']),
+])
+
+
+class BadRequest(Exception):
+    pass
+
+
+async def stream_json_array(result):
+    """Asynchronous version of json.stream_json_array()"""
+    yield '['
+
+    separator = ''
+    async for rows in result.partitions(STREAM_BATCH_SIZE):
+        yield separator + ', '.join(pyjs.dumps(row._asdict()) for row in rows)
+        separator = ', '
+
+    yield ']'
+
+
+async def probe_next_cursor(connection, statement, params, size):
+    """Asynchronous version of json.probe_next_cursor()"""
+    keys = (await connection.execute(statement, dict(params, offset=size - 1))).all()
+
+    if len(keys) < 2:
+        return None
+
+    return encode_cursor(*keys[0])
+
+
+class JSONApp:
+    """ASGI application serving the json blueprint's endpoints from an async SQLAlchemy engine"""
+
+    def __init__(self, engine, page_size=50, max_page_size=200):
+        self.engine = engine
+        self.page_size = page_size
+        self.max_page_size = max_page_size
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+
+        if scope['type'] != 'http':
+            return
+
+        adapter = url_map.bind('localhost')
+        try:
+            endpoint, view_args = adapter.match(scope['path'], scope['method'])
+        except MethodNotAllowed as e:
+            await self.send_error(send, e.code, e.name, [(b'allow', ', '.join(e.valid_methods).encode())])
+            return
+        except HTTPException as e:
+            await self.send_error(send, e.code, e.name)
+            return
+
+        query = {name: values[0] for name, values
+                 in parse_qs(scope['query_string'].decode('latin-1'), keep_blank_values=True).items()}
+
+        async with self.engine.connect() as connection:
+            try:
+                body, next_cursor = await getattr(self, endpoint)(connection, query, **view_args)
+            except BadRequest:
+                await self.send_error(send, 400, "Bad Request")
+                return
+
+            headers = [(b'content-type', b'application/json')]
+            if next_cursor is not None:
+                # Filters and the page size carry over to the next page, as in pagination.next_page_url()
+                args = {name: value for name, value in query.items() if name not in view_args}
+                url = adapter.build(endpoint, dict(view_args, **dict(args, cursor=next_cursor)))
+                headers.append((b'link', f'<{url}>; rel="next"'.encode()))
+
+            await send({'type': 'http.response.start', 'status': 200, 'headers': headers})
+
+            if scope['method'] != 'HEAD':
+                async for chunk in body:
+                    await send({'type': 'http.response.body', 'body': chunk.encode(), 'more_body': True})
+
+            await send({'type': 'http.response.body', 'body': b''})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.engine.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def send_error(self, send, status, message, headers=()):
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(b'content-type', b'text/plain; charset=utf-8'), *headers]})
+        await send({'type': 'http.response.body', 'body': message.encode()})
+
+    def requested_page_size(self, query):
+        try:
+            size = int(query['limit'])
+        except (KeyError, ValueError):
+            size = None
+
+        return clamp_page_size(size, self.page_size, self.max_page_size)
+
+    def requested_cursor(self, query, *types):
+        try:
+            return parse_cursor(query.get('cursor'), *types)
+        except ValueError:
+            raise BadRequest()
+
+    #
+    # Endpoints, each returns the body as an async iterator of strings and the cursor of the next page
+    #
+
+    async def restaurantMenuJSON(self, connection, query, restaurant_id):
+        size = self.requested_page_size(query)
+        try:
+            statement, probe, params = menu_page_query(
+                restaurant_id, query, lambda *types: self.requested_cursor(query, *types))
+        except ValueError:
+            raise BadRequest()
+
+        next_cursor = await probe_next_cursor(connection, probe, params, size)
+        items = await connection.stream(statement, dict(params, limit=size))
+        return stream_json_array(items), next_cursor
+
+    async def menuItemJSON(self, connection, query, restaurant_id, menu_id):
+        items = await connection.execute(MENU_ITEM, {'menu_id': menu_id})
+        body = pyjs.dumps([item._asdict() for item in items])
+
+        async def chunks():
+            yield body
+
+        return chunks(), None
+
+    async def restaurantsJSON(self, connection, query):
+        size = self.requested_page_size(query)
+        cursor = self.requested_cursor(query, str, int)
+
+        if cursor is None:
+            params = {}
+            probe, statement = RESTAURANTS_FIRST_PAGE_PROBE, RESTAURANTS_FIRST_PAGE
+        else:
+            params = {'name': cursor[0], 'id': cursor[1]}
+            probe, statement = RESTAURANTS_PAGE_PROBE, RESTAURANTS_PAGE
+
+        next_cursor = await probe_next_cursor(connection, probe, params, size)
+        restaurants = await connection.stream(statement, dict(params, limit=size))
+        return stream_json_array(restaurants), next_cursor
+
+
+def create_asgi_app(test_config=None):
+    # Settings are resolved exactly as in create_app(), so both apps open the same database
+    app = Flask('project')
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///restaurantmenu.db'
+    app.config.from_prefixed_env()
+
+    if test_config is not None:
+        app.config.update(test_config)
+
+    uri = app.config['SQLALCHEMY_DATABASE_URI']
+    url = make_url(uri)
+    if url.get_backend_name() != 'sqlite':
+        raise ValueError("The asynchronous JSON API only supports SQLite databases")
+
+    options = {'query_cache_size': app.config.get('DATABASE_QUERY_CACHE_SIZE', 1000)}
+    if is_sqlite_file(uri):
+        # Relative paths are relative to the instance folder, as in Flask-SQLAlchemy
+        if not os.path.isabs(url.database):
+            url = url.set(database=os.path.join(app.instance_path, url.database))
+        # aiosqlite defaults to a new connection per checkout, keep them open as the WSGI app does
+        options.update(poolclass=AsyncAdaptedQueuePool, pool_size=app.config.get('DATABASE_POOL_SIZE', 8),
+                       max_overflow=app.config.get('DATABASE_POOL_OVERFLOW', 4), pool_timeout=10)
+
+    engine = create_async_engine(url.set(drivername='sqlite+aiosqlite'), **options)
+    listen_sqlite_pragmas(engine.sync_engine, app.config.get('SQLITE_PRAGMAS', DEFAULT_SQLITE_PRAGMAS))
+
+    return JSONApp(engine, app.config.get('PAGE_SIZE', 50), app.config.get('MAX_PAGE_SIZE', 200))
@@ -0,0 +1,154 @@
+import functools
+import json as pyjs
+import logging
+import os
+import secrets
+import sqlite3
+import threading
+
+
+class InvalidationBus:
+    """
+    Carries cache invalidations between the worker processes of a pre-fork server, see prefork.py, through an
+    SQLite file they all open.
+
+    A function decorated with broadcast(kind) runs in the calling process and is published as a message, and
+    every other worker runs the same function with the same arguments before it handles its next request.
+    Workers check for messages with PRAGMA data_version, which only changes after another connection has
+    written, so requests only query the message table when there is something new.
+
+    Messages older than the newest INVALIDATION_BUS_RETENTION are deleted. A worker that missed some of them
+    runs the 'reset' subscribers, which clear everything it caches.
+
+    Without INVALIDATION_BUS set, broadcast functions only run in the calling process.
+    """
+
+    def __init__(self):
+        self.path = None
+        self.retention = 10000
+        self.nonce = None
+        self.position = 0
+        self.origin = None
+        self._subscribers = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        app.config.setdefault('INVALIDATION_BUS', None)
+        app.config.setdefault('INVALIDATION_BUS_RETENTION', 10000)
+
+        self.configure(app.config['INVALIDATION_BUS'], app.config['INVALIDATION_BUS_RETENTION'])
+        if self.path is not None:
+            app.before_request(self.poll)
+
+    def configure(self, path, retention=10000):
+        self.path = path or None
+        if self.path is None:
+            return
+
+        self.retention = retention
+        # Told apart from pids, which are reused
+        self.origin = f"{os.getpid()}-{secrets.token_hex(4)}"
+        self._local = threading.local()
+
+        connection = self._connection()
+        connection.execute("CREATE TABLE IF NOT EXISTS message (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                           "origin TEXT NOT NULL, kind TEXT NOT NULL, args TEXT NOT NULL)")
+        connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        connection.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('nonce', ?)", (secrets.token_hex(4),))
+        self.nonce = connection.execute("SELECT value FROM meta WHERE key = 'nonce'").fetchone()[0]
+
+        with self._lock:
+            self.position = connection.execute("SELECT coalesce(max(id), 0) FROM message").fetchone()[0]
+            self._run('reset', None, ())
+
+    @property
+    def message_id(self):
+        """Id of the message whose functions are running on this thread, None outside of them or without a bus"""
+        return getattr(self._local, 'message_id', None)
+
+    def subscribe(self, kind, function):
+        self._subscribers.setdefault(kind, []).append(function)
+
+    def broadcast(self, kind):
+        """Decorator publishing every call of a function with JSON serialisable arguments to the other workers"""
+        def decorator(function):
+            self.subscribe(kind, function)
+
+            @functools.wraps(function)
+            def wrapper(*args):
+                message_id = self.publish(kind, *args)
+                self._call(message_id, function, args)
+
+            return wrapper
+
+        return decorator
+
+    def publish(self, kind, *args):
+        """Send a message to the other workers. Returns its id, or None without a bus."""
+        if self.path is None:
+            return None
+
+        connection = self._connection()
+        message_id = connection.execute("INSERT INTO message (origin, kind, args) VALUES (?, ?, ?)",
+                                        (self.origin, kind, pyjs.dumps(args))).lastrowid
+
+        if message_id % 100 == 0:
+            connection.execute("DELETE FROM message WHERE id <= ?", (message_id - self.retention,))
+
+        return message_id
+
+    def poll(self):
+        """Run the functions of every message published by other workers since the last poll"""
+        if self.path is None:
+            return
+
+        connection = self._connection()
+        data_version = connection.execute("PRAGMA data_version").fetchone()[0]
+        if data_version == getattr(self._local, 'data_version', None):
+            return
+        self._local.data_version = data_version
+
+        with self._lock:
+            rows = connection.execute("SELECT id, origin, kind, args FROM message WHERE id > ? ORDER BY id",
+                                      (self.position,)).fetchall()
+
+            if rows and rows[0][0] > self.position + 1:
+                # Messages were deleted before this worker saw them
+                logging.warning("Missed cache invalidations, clearing all caches.")
+                self.position = rows[-1][0]
+                self._run('reset', None, ())
+                return
+
+            for message_id, origin, kind, args in rows:
+                self.position = message_id
+                if origin != self.origin:
+                    self._run(kind, message_id, pyjs.loads(args))
+
+    def _run(self, kind, message_id, args):
+        for function in self._subscribers.get(kind, ()):
+            try:
+                self._call(message_id, function, args)
+            except Exception:
+                logging.exception(f"Failed to apply {kind} invalidation.")
+
+    def _call(self, message_id, function, args):
+        self._local.message_id = message_id
+        try:
+            function(*args)
+        finally:
+            self._local.message_id = None
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+
+        return connection
+
+
+invalidation_bus = InvalidationBus()
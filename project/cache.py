@@ -0,0 +1,125 @@
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from .bus import invalidation_bus
+
+
+class LRUCache:
+    """Thread safe in-memory cache with a size bound and an optional time to live (in seconds)"""
+
+    def __init__(self, max_size=1024, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+
+            if entry is None:
+                self.misses += 1
+                return default
+
+            value, expires = entry
+            if expires is not None and expires < time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+
+        return None if entry is None else entry[0]
+
+    def pop_matching(self, predicate):
+        """Remove every entry whose key satisfies predicate. Returns the number of entries removed."""
+        with self._lock:
+            keys = [key for key in self._data if predicate(key)]
+            for key in keys:
+                del self._data[key]
+
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def configure(self, max_size=None, ttl=None):
+        with self._lock:
+            if max_size is not None:
+                self.max_size = max_size
+            self.ttl = ttl
+
+    def stats(self):
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    def __len__(self):
+        return len(self._data)
+
+
+class ResourceVersions:
+    """
+    Version counters for cacheable resources, bumped whenever a resource changes.
+
+    ETags are built from the version and a random per-process nonce, so tags never survive a restart.
+
+    With the invalidation bus, bumps are made by broadcast functions and a resource's version is the id of the
+    message that last changed it, so every worker gives out the same tags. Resources unchanged since a worker
+    started share the bus position it started at.
+    """
+
+    def __init__(self):
+        self.nonce = secrets.token_hex(4)
+        self.baseline = 0
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def bump(self, key):
+        message_id = invalidation_bus.message_id
+
+        with self._lock:
+            if message_id is None:
+                self._versions[key] = self._versions.get(key, 0) + 1
+            else:
+                self._versions[key] = message_id
+
+    def etag(self, key):
+        return f"{self.nonce}-{self._versions.get(key, self.baseline)}"
+
+    def reset(self):
+        """Forget every version, starting over from the invalidation bus's current position"""
+        with self._lock:
+            self.nonce = invalidation_bus.nonce
+            self.baseline = f"b{invalidation_bus.position}"
+            self._versions.clear()
+
+
+resource_versions = ResourceVersions()
+invalidation_bus.subscribe('reset', resource_versions.reset)
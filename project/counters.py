@@ -0,0 +1,47 @@
+import time
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import func, or_, select, update
+
+from . import db
+from .models import Restaurant, MenuItem, Comment
+
+#
+# Denormalised per-restaurant aggregates, so the restaurant list shows menu sizes and comment counts without
+# counting rows for every restaurant. The counters are adjusted in the same transaction as the rows they
+# count, and rebuild() recounts them from the tables should they ever drift.
+#
+
+
+def adjust(restaurant_id, items=0, comments=0):
+    """Add to a restaurant's counters and mark it updated. Call before committing the change being counted."""
+    db.session.execute(update(Restaurant).where(Restaurant.id == restaurant_id).values(
+        item_count=Restaurant.item_count + items,
+        comment_count=Restaurant.comment_count + comments,
+        updated_at=int(time.time()),
+    ))
+
+
+def rebuild():
+    """Recount every restaurant's items and comments. Returns the number of restaurants that had drifted."""
+    items = select(func.count()).where(MenuItem.restaurant_id == Restaurant.id).scalar_subquery()
+    comments = select(func.count()).where(Comment.restaurantid == Restaurant.id).scalar_subquery()
+
+    statement = update(Restaurant).where(or_(Restaurant.item_count != items, Restaurant.comment_count != comments)) \
+        .values(item_count=items, comment_count=comments)
+    drifted = db.session.execute(statement).rowcount
+    db.session.commit()
+
+    return drifted
+
+
+def init_app(app):
+    app.cli.add_command(rebuild_counters_command)
+
+
+@click.command('rebuild-counters')
+@with_appcontext
+def rebuild_counters_command():
+    """Recount the menu items and comments of every restaurant."""
+    click.echo(f"Corrected the counters of {rebuild()} restaurants.")
@@ -0,0 +1,63 @@
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+
+from . import db
+
+# Tuned for many waitress threads reading while a few write: WAL lets readers run alongside the writer,
+# and synchronous=NORMAL is durable in WAL mode except across a power loss.
+DEFAULT_SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,  # milliseconds to wait for the write lock before failing
+    'mmap_size': 268435456,  # 256 MiB
+    'cache_size': -65536,  # 64 MiB per connection, negative values are KiB
+    'temp_store': 'MEMORY',
+}
+
+
+def is_sqlite_file(uri):
+    url = make_url(uri)
+    return url.get_backend_name() == 'sqlite' and url.database not in (None, '', ':memory:')
+
+
+def init_app(app):
+    """
+    Initialise SQLAlchemy for the app with the database profile in its config:
+
+    SQLITE_PRAGMAS is applied to every new SQLite connection, set it to {} to keep SQLite's defaults.
+    DATABASE_POOL_SIZE and DATABASE_POOL_OVERFLOW size the connection pool for a file database, they should
+    cover the number of server threads.
+    DATABASE_QUERY_CACHE_SIZE is the number of compiled statements SQLAlchemy keeps per engine.
+    """
+    app.config.setdefault('SQLITE_PRAGMAS', DEFAULT_SQLITE_PRAGMAS)
+    app.config.setdefault('DATABASE_POOL_SIZE', 8)
+    app.config.setdefault('DATABASE_POOL_OVERFLOW', 4)
+    app.config.setdefault('DATABASE_QUERY_CACHE_SIZE', 1000)
+
+    options = app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {})
+    options.setdefault('query_cache_size', app.config['DATABASE_QUERY_CACHE_SIZE'])
+
+    if is_sqlite_file(app.config['SQLALCHEMY_DATABASE_URI']):
+        options.setdefault('pool_size', app.config['DATABASE_POOL_SIZE'])
+        options.setdefault('max_overflow', app.config['DATABASE_POOL_OVERFLOW'])
+        options.setdefault('pool_timeout', 10)
+
+    db.init_app(app)
+
+    with app.app_context():
+        for engine in db.engines.values():
+            listen_sqlite_pragmas(engine, app.config['SQLITE_PRAGMAS'])
+
+
+def listen_sqlite_pragmas(engine, pragmas):
+    """Apply the pragmas to every new connection of a SQLite engine"""
+    if not pragmas or engine.dialect.name != 'sqlite':
+        return
+
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+    event.listen(engine, 'connect', set_sqlite_pragmas)
@@ -0,0 +1,97 @@
+import atexit
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+from werkzeug import security
+
+
+class HashingBusy(Exception):
+    """Raised instead of queueing a password hash when the pool is already at its limit"""
+
+
+class PasswordHasher:
+    """
+    Runs scrypt password hashing and verification in a small process pool, so a burst of logins
+    cannot occupy every server thread with CPU bound work.
+
+    At most max_pending hashes may be running or queued at once, further requests fail immediately
+    with HashingBusy. With no workers the hashes are computed inline on the calling thread.
+    """
+
+    def __init__(self):
+        self.workers = 0
+        self.max_pending = 0
+        self.timeout = None
+        self.rejections = 0
+        self.in_flight = 0
+        self._executor = None
+        self._slots = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        app.config.setdefault('PASSWORD_HASH_WORKERS', min(4, multiprocessing.cpu_count()))
+        app.config.setdefault('PASSWORD_HASH_QUEUE', 8 * app.config['PASSWORD_HASH_WORKERS'])
+        app.config.setdefault('PASSWORD_HASH_TIMEOUT', 10)
+
+        self.configure(app.config['PASSWORD_HASH_WORKERS'], app.config['PASSWORD_HASH_QUEUE'],
+                       app.config['PASSWORD_HASH_TIMEOUT'])
+
+    def configure(self, workers, max_pending, timeout):
+        if workers != self.workers:
+            self.shutdown()
+            if workers > 0:
+                # spawn, as forking a process with running server threads is unsafe
+                self._executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_pending) if max_pending > 0 else None
+
+    def generate(self, password):
+        return self._run(security.generate_password_hash, password, "scrypt")
+
+    def check(self, pwhash, password):
+        return self._run(security.check_password_hash, pwhash, password)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+
+    def _run(self, function, *args):
+        if self._executor is None:
+            return function(*args)
+
+        slots = self._slots
+        if slots is None or not slots.acquire(blocking=False):
+            with self._lock:
+                self.rejections += 1
+            raise HashingBusy()
+
+        with self._lock:
+            self.in_flight += 1
+        try:
+            try:
+                future = self._executor.submit(function, *args)
+            except BaseException:
+                slots.release()
+                raise
+
+            # A running hash can't be cancelled, so its slot is only freed once it has finished
+            future.add_done_callback(lambda future: slots.release())
+            try:
+                return future.result(self.timeout)
+            except TimeoutError:
+                future.cancel()
+                with self._lock:
+                    self.rejections += 1
+                raise HashingBusy()
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+
+password_hasher = PasswordHasher()
+atexit.register(password_hasher.shutdown)
@@ -1,31 +1,229 @@
-from flask import Blueprint, jsonify
-from .models import Restaurant, MenuItem
-from sqlalchemy import text
+import functools
+import zlib
+
+from flask import Blueprint, abort, jsonify, request, Response, stream_with_context
+from .cache import resource_versions
+from .models import Restaurant, MenuItem, parse_menu_filters
+from .pagination import page_size, decode_cursor, encode_cursor, next_page_url
+from .search import search
+from sqlalchemy import Integer, bindparam, case, func, literal, select, tuple_
 from . import db
 import json as pyjs
 
 json = Blueprint('json', __name__)
 
+# Rows fetched from the database cursor per chunk of a streamed response
+STREAM_BATCH_SIZE = 500
+
+#
+# Statements are built once here and only ever given new parameters, so SQLAlchemy compiles each of them
+# once per engine and serves them from its compiled cache afterwards.
+#
+
+menu_item = MenuItem.__table__
+restaurant = Restaurant.__table__
+
+# Items keep their original fields, with the price formatted as before next to the price in cents
+price_cents = menu_item.c.price_cents
+menu_item_columns = (
+    menu_item.c.name, menu_item.c.id, menu_item.c.description,
+    case((price_cents.is_(None), literal('')),
+         else_=func.printf(literal('$%d.%02d'), price_cents // 100, price_cents % 100)).label('price'),
+    price_cents, menu_item.c.course, menu_item.c.restaurant_id,
+)
+
+menu_filter_conditions = {
+    'course': menu_item.c.course == bindparam('course'),
+    'min_price': price_cents >= bindparam('min_price'),
+    'max_price': price_cents <= bindparam('max_price'),
+}
+
+
+@functools.lru_cache(maxsize=None)
+def menu_page_statements(filters=(), by_price=False):
+    """
+    Statements for a page of a menu and its probe, for a tuple of filter names from menu_filter_conditions.
+    Menus sorted by price leave out items without a price and page by (price_cents, id) instead of by id.
+    """
+    conditions = [menu_item.c.restaurant_id == bindparam('restaurant_id')]
+    conditions.extend(menu_filter_conditions[name] for name in filters)
+
+    if by_price:
+        order = (price_cents, menu_item.c.id)
+        after = (bindparam('after_price', type_=Integer), bindparam('after', type_=Integer))
+        conditions.append(tuple_(*order) > tuple_(*after))
+    else:
+        order = (menu_item.c.id,)
+        conditions.append(menu_item.c.id > bindparam('after'))
+
+    page = select(*menu_item_columns).where(*conditions).order_by(*order).limit(bindparam('limit')) \
+        .execution_options(yield_per=STREAM_BATCH_SIZE)
+    probe = select(*order).where(*conditions).order_by(*order).limit(2).offset(bindparam('offset'))
+    return page, probe
+
+
+def menu_page_query(restaurant_id, args, cursor_values):
+    """
+    The page and probe statements and their parameters for a menu requested with query string arguments args.
+    cursor_values(*types) returns the decoded cursor. Raises ValueError for invalid filters.
+    """
+    filters = parse_menu_filters(args)
+    by_price = filters.pop('sort', None) == 'price'
+    params = dict(filters, restaurant_id=restaurant_id)
+
+    if by_price:
+        # Prices are never negative, so the first page starts after (-1, 0)
+        cursor = cursor_values(int, int) or (-1, 0)
+        params.update(after_price=cursor[0], after=cursor[1])
+    else:
+        cursor = cursor_values(int)
+        params['after'] = 0 if cursor is None else cursor[0]
+
+    page, probe = menu_page_statements(tuple(sorted(filters)), by_price)
+    return page, probe, params
+
+
+MENU_PAGE, MENU_PAGE_PROBE = menu_page_statements()
+
+MENU_ITEM = select(*menu_item_columns).where(menu_item.c.id == bindparam('menu_id')).limit(1)
+
+restaurant_order = (restaurant.c.name, restaurant.c.id)
+restaurants_after = tuple_(*restaurant_order) > tuple_(bindparam('name'), bindparam('id'))
+RESTAURANTS_FIRST_PAGE = select(restaurant).order_by(*restaurant_order).limit(bindparam('limit')) \
+    .execution_options(yield_per=STREAM_BATCH_SIZE)
+RESTAURANTS_FIRST_PAGE_PROBE = select(*restaurant_order).order_by(*restaurant_order) \
+    .limit(2).offset(bindparam('offset'))
+RESTAURANTS_PAGE = RESTAURANTS_FIRST_PAGE.where(restaurants_after)
+RESTAURANTS_PAGE_PROBE = RESTAURANTS_FIRST_PAGE_PROBE.where(restaurants_after)
+
+
+def resource_etag(key):
+    """Tag for the current version of a resource, distinguishing pages of the same resource"""
+    etag = resource_versions.etag(key)
+
+    if request.query_string:
+        etag += '-%08x' % zlib.crc32(request.query_string)
+
+    return etag
+
+
+def not_modified(etag):
+    """Returns a 304 response if the client already holds this version of the resource, otherwise None"""
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    return None
+
+
+def begin_read():
+    """
+    Begin a transaction on the session's connection if none is open. pysqlite runs SELECTs outside of any, so
+    without one each statement reads the latest commit, and rows written between two of them are seen by one only.
+    """
+    connection = db.session.connection()
+    if connection.dialect.name == 'sqlite' and not connection.connection.dbapi_connection.in_transaction:
+        connection.exec_driver_sql("BEGIN")
+
+
+def probe_next_cursor(statement, params, size):
+    """
+    Find the cursor for the page after this one without loading the page. statement selects only the sort key
+    columns, and is run with the offset of the last row on this page, returning that row and the next one if any.
+    Begins a read transaction, so the page read next sees the same rows and ends where the cursor points.
+    """
+    begin_read()
+    keys = db.session.execute(statement, dict(params, offset=size - 1)).all()
+
+    if len(keys) < 2:
+        return None
+
+    return encode_cursor(*keys[0])
+
+
+def stream_json_array(result):
+    """
+    Encode a result as a JSON array one batch of rows at a time, so the whole result is never held in memory.
+    The output is identical to json.dumps() of the list of row dicts.
+    """
+    yield '['
+
+    separator = ''
+    for rows in result.partitions():
+        yield separator + ', '.join(pyjs.dumps(row._asdict()) for row in rows)
+        separator = ', '
+
+    yield ']'
+
+
+def json_response(body, etag, next_cursor=None):
+    response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+
+    if next_cursor is not None:
+        response.headers['Link'] = '<%s>; rel="next"' % next_page_url(next_cursor)
+
+    return response
+
+
 #JSON APIs to view Restaurant Information
-@json.route('/restaurant/<restaurant_id>/menu/JSON')
+@json.route('/restaurant/<int:restaurant_id>/menu/JSON')
 def restaurantMenuJSON(restaurant_id):
+    # Read the version before querying, so a concurrent change can only make the tag older than the body
+    etag = resource_etag(('menu', restaurant_id))
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+
+    size = page_size()
+    try:
+        statement, probe, params = menu_page_query(restaurant_id, request.args, decode_cursor)
+    except ValueError:
+        abort(400)
+
+    next_cursor = probe_next_cursor(probe, params, size)
+
     # An SQL injection vulnerability was found and fixed here, by switching from string concatenation to SQL parameterisation
-    items = db.session.execute(text('select * from menu_item where restaurant_id = %s'), (restaurant_id))
-    items_list = [ i._asdict() for i in items ]
-    return pyjs.dumps(items_list)
+    items = db.session.execute(statement, dict(params, limit=size))
+    return json_response(stream_with_context(stream_json_array(items)), etag, next_cursor)
 
 
-@json.route('/restaurant/<restaurant_id>/menu/<int:menu_id>/JSON')
+@json.route('/restaurant/<int:restaurant_id>/menu/<int:menu_id>/JSON')
 def menuItemJSON(restaurant_id, menu_id):
+    etag = resource_etag(('item', menu_id))
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+
     # An SQL injection vulnerability was found and fixed here, by switching from string concatenation to SQL parameterisation
-    Menu_Item = db.session.execute(text('select * from menu_item where id = %s limit 1'), (str(menu_id)))
+    Menu_Item = db.session.execute(MENU_ITEM, {'menu_id': menu_id})
     items_list = [ i._asdict() for i in Menu_Item ]
-    return pyjs.dumps(items_list)
+    return json_response(pyjs.dumps(items_list), etag)
 
 @json.route('/restaurant/JSON')
 def restaurantsJSON():
-    restaurants = db.session.execute(text('select * from restaurant'))
-    rest_list = [ r._asdict() for r in restaurants ]
-    return pyjs.dumps(rest_list)
+    etag = resource_etag('restaurants')
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+
+    size = page_size()
+    cursor = decode_cursor(str, int)
+
+    if cursor is None:
+        params = {}
+        probe, query = RESTAURANTS_FIRST_PAGE_PROBE, RESTAURANTS_FIRST_PAGE
+    else:
+        params = {'name': cursor[0], 'id': cursor[1]}
+        probe, query = RESTAURANTS_PAGE_PROBE, RESTAURANTS_PAGE
+
+    next_cursor = probe_next_cursor(probe, params, size)
+    restaurants = db.session.execute(query, dict(params, limit=size))
+    return json_response(stream_with_context(stream_json_array(restaurants)), etag, next_cursor)
 
 
+@json.route('/search/JSON')
+def searchJSON():
+    results = search(request.args.get('q', ''), page_size())
+    return Response(pyjs.dumps(results), mimetype='application/json')
@@ -1,20 +1,53 @@
 import calendar
+import functools
+import io
 import logging
 import secrets
-import tempfile
-from datetime import datetime
+from datetime import datetime, timezone
+
+from flask import Blueprint, render_template, request, flash, redirect, url_for, session, g, abort
+from sqlalchemy import asc, delete, tuple_
+from sqlalchemy.orm import joinedload, selectinload
+
+from . import counters, db
+from .bus import invalidation_bus
+from .cache import LRUCache, resource_versions
+from .hashing import password_hasher, HashingBusy
+from .models import Restaurant, MenuItem, Comment, User, UserToken, parse_menu_filters, parse_price
+from .pagination import page_size, decode_cursor, split_page, next_page_url
+from .ratelimit import rate_limited, RateLimited
+from .search import search
+from .sessions import session_cache, TOKEN_LIFETIME
 
-import pyotp
-import pyqrcode
-import werkzeug
-from flask import Blueprint, render_template, request, flash, redirect, url_for, session
-from sqlalchemy import asc
-from werkzeug import security
+main = Blueprint('main', __name__)
 
-from . import db
-from .models import Restaurant, MenuItem, Comment, User, UserToken
+COURSES = ('Appetizer', 'Entree', 'Dessert', 'Beverage')
 
-main = Blueprint('main', __name__)
+# Grouped menus by restaurant id, see group_menu()
+menu_cache = LRUCache(max_size=512)
+
+# Rendered pages by (page, restaurant id, user id, query string), see cached_page()
+page_cache = LRUCache(max_size=256)
+
+# TOTP provisioning QR code SVGs by (user id, secret), see totp_qr_code()
+qr_cache = LRUCache(max_size=256)
+
+
+def clear_caches():
+    menu_cache.clear()
+    page_cache.clear()
+    qr_cache.clear()
+
+
+# Run by workers that missed invalidations from the others
+invalidation_bus.subscribe('reset', clear_caches)
+
+
+@main.record_once
+def configure_caches(state):
+    menu_cache.configure(max_size=state.app.config.get('MENU_CACHE_SIZE', 512))
+    page_cache.configure(max_size=state.app.config.get('PAGE_CACHE_SIZE', 256))
+    qr_cache.configure(max_size=state.app.config.get('QR_CACHE_SIZE', 256))
 
 
 #
@@ -25,6 +58,15 @@ def getTime():
     return calendar.timegm(datetime.utcnow().utctimetuple())
 
 
+@main.app_template_filter('date')
+def format_date(timestamp):
+    """Seconds since the epoch as a date, for templates"""
+    if timestamp is None:
+        return ''
+
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime('%d %b %Y')
+
+
 def create_session(email, password):
     user = db.session.query(User).filter_by(email=email).one_or_none()
 
@@ -32,7 +74,7 @@ def create_session(email, password):
         return None, None
 
     # Check password
-    if security.check_password_hash(user.password, password):
+    if password_hasher.check(user.password, password):
 
         new_token = secrets.token_hex(16)
 
@@ -52,6 +94,7 @@ def create_session(email, password):
         session['token'] = token.token
         db.session.add(token)
         db.session.commit()
+        forget_user()
 
         return user, token
 
@@ -63,9 +106,13 @@ def get_session_token(token: str) -> UserToken:
 
 
 def upgrade_session(user: User, token: UserToken, code):
+    import pyotp
+
     if pyotp.TOTP(user.totp).verify(code):
         token.trusted = True
         db.session.commit()
+        session_cache.invalidate(token.token)
+        forget_user()
 
     return user, token
 
@@ -76,40 +123,191 @@ def destroy_session():
     if token is None:
         return
 
-    db.session.delete(db.session.query(UserToken).filter_by(token=token).one_or_none())
+    db.session.query(UserToken).filter_by(token=token).delete()
     db.session.commit()
+    # After the commit, so no other worker can cache the token again from the row
+    session_cache.invalidate(token)
 
     session.pop('token', None)
+    forget_user()
 
 
-def getUser(insecure=False):
+def resolve_session():
+    """Look up the user behind the session token. Returns a (user, trusted) pair."""
+    session_cache.resolutions += 1
+
     if 'token' not in session:
-        return None
+        return None, False
 
     token = session.get('token')
-    token_object = db.session.query(UserToken).filter_by(token=token).one_or_none()
+    cached = session_cache.lookup(token)
 
-    if token_object is None:
-        return None
+    if cached is None:
+        token_object = db.session.query(UserToken).filter_by(token=token).one_or_none()
+
+        if token_object is None:
+            return None, False
+
+        cached = session_cache.store(token_object)
 
-    if token_object.tolu < getTime() - 2592000:  # One month token expiry period
-        db.session.delete(token)
+    now = getTime()
+    if cached.tolu < now - TOKEN_LIFETIME:
+        db.session.query(UserToken).filter_by(token=token).delete()
         db.session.commit()
+        session_cache.invalidate(token)
 
         session.pop('token', None)
 
-        return None
+        return None, False
 
-    if insecure is False and not token_object.trusted:
-        return None
+    # The new time of last use is written back in batches by the session cache
+    session_cache.touch(token, cached, now)
 
-    token_object.tolu = getTime()
-    db.session.commit()
+    return db.session.get(User, cached.user_id), cached.trusted
+
+
+def getUser(insecure=False):
+    # The session is resolved at most once per request, views and templates share the result
+    if 'session_user' not in g:
+        g.session_user = resolve_session()
+
+    user, trusted = g.session_user
+
+    if insecure is False and not trusted:
+        return None
 
-    user = db.session.query(User).filter_by(id=token_object.id).one_or_none()
     return user
 
 
+def forget_user():
+    g.pop('session_user', None)
+
+
+@main.app_context_processor
+def inject_user():
+    return {'user': getUser()}
+
+
+@main.errorhandler(HashingBusy)
+def password_hashing_busy(error):
+    # Shed load instead of queueing behind a burst of logins
+    return "Too many sign ins in progress, please try again shortly.", 503, {'Retry-After': '1'}
+
+
+@main.errorhandler(RateLimited)
+def rate_limit_exceeded(error):
+    return "Too many attempts, please try again later.", 429, {'Retry-After': str(error.retry_after)}
+
+
+def form_account():
+    """The account named by a sign in or sign up form, for rate limiting"""
+    return request.form.get('email', '').strip().lower() or None
+
+
+def session_account():
+    """The session a 2FA code is entered for, for rate limiting without looking up its user"""
+    return session.get('token')
+
+
+def group_menu(items):
+    """
+    Group menu items by course in a single pass. Courses keep the order of COURSES and items with any other
+    course are collected under 'Other'. Empty courses are left out.
+    """
+    groups = {course: [] for course in COURSES + ('Other',)}
+
+    for item in items:
+        groups.get(item.course, groups['Other']).append(item.serialize)
+
+    return {course: group for course, group in groups.items() if group}
+
+
+@invalidation_bus.broadcast('restaurant')
+def restaurant_changed(restaurant_id):
+    """Drop everything cached for a restaurant's menu page. Call after committing a change to it."""
+    menu_cache.pop(restaurant_id)
+    page_cache.pop_matching(lambda key: key[1] == restaurant_id)
+    resource_versions.bump(('menu', restaurant_id))
+
+
+@invalidation_bus.broadcast('restaurants')
+def restaurants_changed():
+    """Drop the cached restaurant list. Call after committing a change to a restaurant's name, existence or counters."""
+    page_cache.pop_matching(lambda key: key[0] == 'restaurants')
+    resource_versions.bump('restaurants')
+
+
+@invalidation_bus.broadcast('item')
+def menu_item_changed(menu_id):
+    """Call after committing a change to a single menu item, as well as restaurant_changed()"""
+    resource_versions.bump(('item', menu_id))
+
+
+def delete_restaurant(restaurant):
+    """
+    Delete a restaurant with its menu items and comments, one set-based DELETE per table through the restaurant
+    id indexes. Doesn't commit, so everything goes in the caller's transaction. Returns the deleted item ids.
+    """
+    item_ids = db.session.scalars(
+        delete(MenuItem).where(MenuItem.restaurant_id == restaurant.id).returning(MenuItem.id)).all()
+    db.session.execute(delete(Comment).where(Comment.restaurantid == restaurant.id))
+    db.session.delete(restaurant)
+
+    return item_ids
+
+
+def totp_qr_code(user):
+    """The SVG QR code that provisions the user's TOTP secret in an authenticator app"""
+    key = (user.id, user.totp)
+    svg = qr_cache.get(key)
+
+    if svg is None:
+        # The 2FA libraries are imported by the few views using them, not while the server starts
+        import pyotp
+        import pyqrcode
+
+        url = pyotp.TOTP(user.totp).provisioning_uri(name=user.email, issuer_name='COMP3310 Restaurant App')
+        buffer = io.BytesIO()
+        pyqrcode.create(url).svg(buffer, scale=7, xmldecl=False)
+        svg = buffer.getvalue().decode()
+        qr_cache.set(key, svg)
+
+    return svg
+
+
+@invalidation_bus.broadcast('qr')
+def forget_qr_codes(user_id):
+    """Call when a user's TOTP secret is replaced or removed"""
+    qr_cache.pop_matching(lambda key: key[0] == user_id)
+
+
+def cached_page(name):
+    """
+    Serve GET requests for the decorated view from page_cache. Pages are cached separately for anonymous
+    visitors and for each logged in user, and pages with pending flash messages are never cached.
+    """
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(**kwargs):
+            if request.method != 'GET' or session.get('_flashes'):
+                return view(**kwargs)
+
+            user = getUser()
+            key = (name, kwargs.get('restaurant_id'), None if user is None else user.id, request.query_string)
+
+            page = page_cache.get(key)
+            if page is None:
+                page = view(**kwargs)
+                page_cache.set(key, page)
+
+            return page
+
+        return wrapper
+
+    return decorator
+
+
 #
 # VIEW METHODS
 #
@@ -118,9 +316,25 @@ def getUser(insecure=False):
 # Show all restaurants
 @main.route('/')
 @main.route('/restaurant/')
+@cached_page('restaurants')
 def showRestaurants():
-    restaurants = db.session.query(Restaurant).order_by(asc(Restaurant.name))
-    return render_template('restaurants.html', restaurants=restaurants, user=getUser())
+    size = page_size()
+    query = db.session.query(Restaurant).order_by(asc(Restaurant.name), asc(Restaurant.id))
+
+    cursor = decode_cursor(str, int)
+    if cursor is not None:
+        query = query.filter(tuple_(Restaurant.name, Restaurant.id) > tuple_(*cursor))
+
+    restaurants, next_cursor = split_page(query.limit(size + 1).all(), size, lambda r: (r.name, r.id))
+    return render_template('restaurants.html', restaurants=restaurants, next_page=next_page_url(next_cursor))
+
+
+# Search restaurants, menu items and comments
+@main.route('/search/')
+def showSearch():
+    terms = request.args.get('q', '')
+    results = search(terms, page_size())
+    return render_template('search.html', terms=terms, results=results)
 
 
 # Create a new restaurant
@@ -145,6 +359,7 @@ def newRestaurant():
             if user.permission == 0:
                 user.permission = 1
             db.session.commit()  # commit twice because the first one generates a restaurant ID
+            restaurants_changed()
             flash(f'New Restaurant {new_restaurant.name} Successfully Created')
         else:
             flash('User already belongs to a restaurant')
@@ -162,7 +377,10 @@ def editRestaurant(restaurant_id):
         if user != None and user.restaurant == restaurant_id:
             if request.form['name']:
                 editedRestaurant.name = request.form['name']
+                counters.adjust(restaurant_id)
                 db.session.commit()
+                restaurant_changed(restaurant_id)
+                restaurants_changed()
                 flash('Restaurant Successfully Edited %s' % editedRestaurant.name)
         else:
             flash('Failed to edit restaurant')
@@ -178,12 +396,16 @@ def deleteRestaurant(restaurant_id):
     restaurantToDelete = db.session.query(Restaurant).filter_by(id=restaurant_id).one()
     if request.method == 'POST':
         if user != None and user.restaurant == restaurant_id:
-            db.session.delete(restaurantToDelete)
+            item_ids = delete_restaurant(restaurantToDelete)
             flash('%s Successfully Deleted' % restaurantToDelete.name)
             user.restaurant = None
             if user.permission == 1:
                 user.permission = 0
             db.session.commit()
+            restaurant_changed(restaurant_id)
+            restaurants_changed()
+            for item_id in item_ids:
+                menu_item_changed(item_id)
         else:
             flash('Failed to delete restaurant')
         return redirect(url_for('main.showRestaurants', restaurant_id=restaurant_id))
@@ -194,12 +416,54 @@ def deleteRestaurant(restaurant_id):
 # Show a restaurant menu and comments
 @main.route('/restaurant/<int:restaurant_id>/')
 @main.route('/restaurant/<int:restaurant_id>/menu/')
+@cached_page('menu')
 def showMenu(restaurant_id):
     user = getUser()
-    restaurant = db.session.query(Restaurant).filter_by(id=restaurant_id).one()
-    items = db.session.query(MenuItem).filter_by(restaurant_id=restaurant_id).all()
-    comments = db.session.query(Comment).filter_by(restaurantid=restaurant_id).all()
-    return render_template('menu.html', comments=comments, items=items, restaurant=restaurant, user=getUser())
+
+    try:
+        filters = parse_menu_filters(request.args)
+    except ValueError:
+        abort(400)
+
+    if filters:
+        return showFilteredMenu(restaurant_id, filters, user)
+
+    menu = menu_cache.get(restaurant_id)
+
+    # Load the restaurant with its items, then the comments with their authors, in two queries.
+    # The items are only needed when the grouped menu isn't cached yet.
+    options = [selectinload(Restaurant.comments).joinedload(Comment.user)]
+    if menu is None:
+        options.append(joinedload(Restaurant.items))
+    restaurant = db.session.query(Restaurant).options(*options).filter_by(id=restaurant_id).one()
+
+    if menu is None:
+        menu = group_menu(restaurant.items)
+        menu_cache.set(restaurant_id, menu)
+
+    return render_template('menu.html', comments=restaurant.comments, menu=menu, restaurant=restaurant, user=user,
+                           filters={})
+
+
+def showFilteredMenu(restaurant_id, filters, user):
+    """The menu page showing only the items matching the filters, which are served by the course and price index"""
+    restaurant = db.session.query(Restaurant).options(selectinload(Restaurant.comments).joinedload(Comment.user)) \
+        .filter_by(id=restaurant_id).one()
+
+    query = db.session.query(MenuItem).filter(MenuItem.restaurant_id == restaurant_id)
+    if 'course' in filters:
+        query = query.filter(MenuItem.course == filters['course'])
+    if 'min_price' in filters:
+        query = query.filter(MenuItem.price_cents >= filters['min_price'])
+    if 'max_price' in filters:
+        query = query.filter(MenuItem.price_cents <= filters['max_price'])
+    if 'sort' in filters:
+        query = query.order_by(MenuItem.price_cents.is_(None), MenuItem.price_cents, MenuItem.id)
+    else:
+        query = query.order_by(MenuItem.id)
+
+    return render_template('menu.html', comments=restaurant.comments, menu=group_menu(query), restaurant=restaurant,
+                           user=user, filters=filters)
 
 
 # Create a new comment
@@ -216,7 +480,10 @@ def newComment(restaurant_id):
                 username=False if 'name' in request.form and user.restaurant is None else True
             )
             db.session.add(comment)
+            counters.adjust(restaurant_id, comments=1)
             db.session.commit()
+            restaurant_changed(restaurant_id)
+            restaurants_changed()
             flash('New Comment %s Successfully Created' % (comment.title))
             return redirect(url_for('main.showMenu', restaurant_id=restaurant_id, user=user))
         else:
@@ -235,14 +502,16 @@ def newMenuItem(restaurant_id):
         if user != None and user.restaurant == restaurant_id:
 
             # Ensure correct types
-            # float(None) throws TypeError.
-            # float("") throws ValueError
+            # parse_price(None) throws AttributeError.
+            # parse_price("abc") throws ValueError, a missing price is rejected the same way
             try:
                 name = str(request.form.get('name'))
                 description = str(request.form.get('description'))
-                price = float(request.form.get('price'))
+                price = parse_price(request.form.get('price'))
+                if price is None:
+                    raise ValueError("missing price")
                 course = str(request.form.get('course'))
-            except (TypeError, ValueError) as e:
+            except (AttributeError, ValueError) as e:
                 logging.warning(f"Exception processing newMenuItem : {e}")
                 flash("Something went wrong. Please try again.")
                 return redirect(url_for('main.newMenuItem', restaurant_id=restaurant_id))
@@ -250,12 +519,17 @@ def newMenuItem(restaurant_id):
             newItem = MenuItem(
                 name=name,
                 description=description,
-                price=price,
+                price_cents=price,
                 course=course,
                 restaurant_id=restaurant_id
             )
             db.session.add(newItem)
+            counters.adjust(restaurant_id, items=1)
             db.session.commit()
+            restaurant_changed(restaurant_id)
+            restaurants_changed()
+            # Its id may have been requested before, or belonged to an item deleted since
+            menu_item_changed(newItem.id)
             flash('New Menu %s Item Successfully Created' % (newItem.name))
         else:
             flash('Failed to create menu item')
@@ -272,16 +546,27 @@ def editMenuItem(restaurant_id, menu_id):
     restaurant = db.session.query(Restaurant).filter_by(id=restaurant_id).one()
     if request.method == 'POST':
         if user != None and user.restaurant == restaurant_id:
+            item_restaurant_id = editedItem.restaurant_id
+            try:
+                price = parse_price(request.form['price'])
+            except ValueError as e:
+                logging.warning(f"Exception processing editMenuItem : {e}")
+                flash("Invalid price. Please try again.")
+                return redirect(url_for('main.editMenuItem', restaurant_id=restaurant_id, menu_id=menu_id))
             if request.form['name']:
                 editedItem.name = request.form['name']
             if request.form['description']:
                 editedItem.description = request.form['description']
-            if request.form['price']:
-                editedItem.price = request.form['price']
+            if price is not None:
+                editedItem.price_cents = price
             if request.form['course']:
                 editedItem.course = request.form['course']
             db.session.add(editedItem)
+            counters.adjust(item_restaurant_id)
             db.session.commit()
+            restaurant_changed(item_restaurant_id)
+            restaurants_changed()
+            menu_item_changed(menu_id)
             flash('Menu Item Successfully Edited')
         else:
             flash('Failed to edit menu item')
@@ -299,8 +584,13 @@ def deleteMenuItem(restaurant_id, menu_id):
     itemToDelete = db.session.query(MenuItem).filter_by(id=menu_id).one()
     if request.method == 'POST':
         if user != None and user.restaurant == restaurant_id:
+            item_restaurant_id = itemToDelete.restaurant_id
             db.session.delete(itemToDelete)
+            counters.adjust(item_restaurant_id, items=-1)
             db.session.commit()
+            restaurant_changed(item_restaurant_id)
+            restaurants_changed()
+            menu_item_changed(menu_id)
             flash('Menu Item Successfully Deleted')
         else:
             flash('Failed to delete menu item')
@@ -310,6 +600,7 @@ def deleteMenuItem(restaurant_id, menu_id):
 
 
 @main.route('/login/', methods=['GET', 'POST'])
+@rate_limited(form_account)
 def showLogin():
     if request.method == 'POST':
         email = str(request.form.get("email"))
@@ -331,10 +622,11 @@ def showLogin():
         return redirect(url_for('main.showRestaurants'))
 
     if request.method == 'GET':
-        return render_template("login.html", user=getUser())
+        return render_template("login.html")
 
 
 @main.route('/login/stage2', methods=['GET', 'POST'])
+@rate_limited(session_account)
 def login2FA():
     user = getUser(insecure=True)
 
@@ -359,6 +651,7 @@ def login2FA():
 
 
 @main.route('/signup/', methods=['GET', 'POST'])
+@rate_limited(form_account)
 def showSignup():
     if request.method == 'POST':
 
@@ -383,7 +676,7 @@ def showSignup():
 
         newUser = User(name=name,
                        email=email,
-                       password=security.generate_password_hash(password,method="scrypt"),
+                       password=password_hasher.generate(password),
                        permission=0
                        )
         db.session.add(newUser)
@@ -391,12 +684,12 @@ def showSignup():
         db.session.commit()
         return redirect(url_for('main.showLogin'))
     else:
-        return render_template("signup.html", user=getUser())
+        return render_template("signup.html")
 
 
 @main.route('/account/', methods=['GET'])
 def accountSettings():
-    return render_template("account.html", user=getUser())
+    return render_template("account.html")
 
 
 @main.route('/logout/', methods=['POST'])
@@ -416,6 +709,9 @@ def totp():
             return redirect(url_for('main.accountSettings'))
 
         # Generate secret key and redirect to qr code page
+        import pyotp
+
+        forget_qr_codes(user.id)
         user.totp = pyotp.random_base32()
         db.session.commit()
         return redirect(url_for('main.totp'), code=303)
@@ -423,21 +719,13 @@ def totp():
     elif request.method == 'GET':
 
         if user.totp is None:
-            redirect(url_for('main.accountSettings'))
-
-        url = pyotp.TOTP(user.totp).provisioning_uri(name=user.email, issuer_name='COMP3310 Restaurant App')
-        qr = pyqrcode.create(url)
-
-        svg = tempfile.SpooledTemporaryFile(max_size=16 * 1024, mode="rw+b")
-        qr.svg(svg, scale=7)
-
-        svg.seek(0)
-        svg_string = str(svg.read())
+            return redirect(url_for('main.accountSettings'))
 
-        return render_template('totp.html', user=user, qr=svg_string)
+        return render_template('totp.html', user=user, qr=totp_qr_code(user))
 
 
 @main.route('/totp/verify/', methods=['POST'])
+@rate_limited(session_account)
 def totp2():
     user = getUser()
     if user is None:
@@ -447,11 +735,14 @@ def totp2():
     if code is None:
         return redirect(url_for('main.accountSettings'))
 
+    import pyotp
+
     if len(code) == 6 and pyotp.TOTP(user.totp).verify(code):
         user.totp_verified = True
         db.session.commit()
         return redirect(url_for('main.accountSettings'), code=303)
     else:
+        forget_qr_codes(user.id)
         user.totp = None
         user.totp_verified = False
         db.session.commit()
@@ -0,0 +1,254 @@
+import os
+import secrets
+import threading
+import time
+
+from flask import Blueprint, Response, abort, current_app, g, request
+from flask.signals import before_render_template, template_rendered
+from sqlalchemy import event
+
+from . import db
+
+metrics = Blueprint('metrics', __name__)
+
+# Upper bounds of the request duration histogram, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class EndpointStats:
+
+    def __init__(self):
+        self.requests = 0
+        self.seconds = 0.0
+        self.sql_statements = 0
+        self.sql_seconds = 0.0
+        self.template_seconds = 0.0
+        self.buckets = [0] * len(BUCKETS)
+
+
+class Registry:
+    """
+    Per-endpoint request statistics, plus collectors for metrics that other modules keep themselves.
+
+    A collector is a function returning (name, type, help, samples) tuples, where samples is a list of
+    (labels, value) pairs.
+    """
+
+    def __init__(self):
+        self.endpoints = {}
+        self.collectors = []
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, seconds, sql_statements, sql_seconds, template_seconds):
+        with self._lock:
+            stats = self.endpoints.setdefault(endpoint, EndpointStats())
+            stats.requests += 1
+            stats.seconds += seconds
+            stats.sql_statements += sql_statements
+            stats.sql_seconds += sql_seconds
+            stats.template_seconds += template_seconds
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    stats.buckets[i] += 1
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def clear(self):
+        with self._lock:
+            self.endpoints.clear()
+
+    def render(self):
+        """Everything in the Prometheus text exposition format"""
+        with self._lock:
+            endpoints = sorted(self.endpoints.items())
+            lines = []
+
+            def family(name, kind, help_text):
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+
+            family('restaurant_request_duration_seconds', 'histogram', "Wall time of requests by endpoint.")
+            for endpoint, stats in endpoints:
+                for bound, count in zip(BUCKETS, stats.buckets):
+                    lines.append(f'restaurant_request_duration_seconds_bucket{{endpoint="{endpoint}",le="{bound}"}} {count}')
+                lines.append(f'restaurant_request_duration_seconds_bucket{{endpoint="{endpoint}",le="+Inf"}} {stats.requests}')
+                lines.append(f'restaurant_request_duration_seconds_sum{{endpoint="{endpoint}"}} {stats.seconds}')
+                lines.append(f'restaurant_request_duration_seconds_count{{endpoint="{endpoint}"}} {stats.requests}')
+
+            for name, attribute, help_text in (
+                    ('restaurant_sql_statements_total', 'sql_statements', "SQL statements executed by endpoint."),
+                    ('restaurant_sql_seconds_total', 'sql_seconds', "Time spent executing SQL by endpoint."),
+                    ('restaurant_template_seconds_total', 'template_seconds', "Time spent rendering templates by endpoint.")):
+                family(name, 'counter', help_text)
+                for endpoint, stats in endpoints:
+                    lines.append(f'{name}{{endpoint="{endpoint}"}} {getattr(stats, attribute)}')
+
+        for collector in self.collectors:
+            for name, kind, help_text, samples in collector():
+                family(name, kind, help_text)
+                for labels, value in samples:
+                    label_text = ','.join(f'{key}="{label}"' for key, label in labels.items())
+                    lines.append(f'{name}{{{label_text}}} {value}' if label_text else f'{name} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+def collect_caches():
+    from .main import menu_cache, page_cache, qr_cache
+    from .sessions import session_cache
+
+    caches = {'page': page_cache, 'menu': menu_cache, 'qr': qr_cache, 'session': session_cache.tokens}
+    stats = {name: cache.stats() for name, cache in caches.items()}
+
+    return [
+        ('restaurant_cache_hits_total', 'counter', "Cache lookups that found an entry.",
+         [({'cache': name}, s['hits']) for name, s in stats.items()]),
+        ('restaurant_cache_misses_total', 'counter', "Cache lookups that found no entry.",
+         [({'cache': name}, s['misses']) for name, s in stats.items()]),
+        ('restaurant_cache_evictions_total', 'counter', "Entries evicted to keep caches within their size.",
+         [({'cache': name}, s['evictions']) for name, s in stats.items()]),
+        ('restaurant_cache_entries', 'gauge', "Entries currently cached.",
+         [({'cache': name}, s['size']) for name, s in stats.items()]),
+        ('restaurant_session_resolutions_total', 'counter', "Session tokens resolved to users.",
+         [({}, session_cache.resolutions)]),
+        ('restaurant_session_tokens_reclaimed_total', 'counter', "Expired session tokens deleted by the sweeper.",
+         [({}, session_cache.reclaimed)]),
+    ]
+
+
+def collect_password_hashing():
+    from .hashing import password_hasher
+
+    return [
+        ('restaurant_password_hashes_in_flight', 'gauge', "Password hashes running or queued in the worker pool.",
+         [({}, password_hasher.in_flight)]),
+        ('restaurant_password_hash_rejections_total', 'counter', "Password hashes refused because the pool was full.",
+         [({}, password_hasher.rejections)]),
+    ]
+
+
+def collect_rate_limiting():
+    from .ratelimit import rate_limiter
+
+    return [
+        ('restaurant_rate_limit_rejections_total', 'counter', "Sign in, sign up and 2FA attempts over the rate limits.",
+         [({}, rate_limiter.rejections)]),
+    ]
+
+
+registry.add_collector(collect_caches)
+registry.add_collector(collect_password_hashing)
+registry.add_collector(collect_rate_limiting)
+
+
+#
+# Request instrumentation
+#
+
+def start_request():
+    g.metrics_start = time.perf_counter()
+    g.metrics_sql_statements = 0
+    g.metrics_sql_seconds = 0.0
+    g.metrics_template_seconds = 0.0
+
+
+def finish_request(profile_threshold, profile_dir):
+    seconds = time.perf_counter() - g.metrics_start
+    endpoint = request.endpoint or 'unmatched'
+
+    registry.record(endpoint, seconds, g.metrics_sql_statements, g.metrics_sql_seconds, g.metrics_template_seconds)
+
+    profiler = g.pop('metrics_profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        if seconds >= profile_threshold:
+            profiler.dump_stats(os.path.join(profile_dir, f"{endpoint}-{time.time_ns()}.prof"))
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('metrics_query_start', []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.perf_counter() - conn.info['metrics_query_start'].pop()
+
+    # Statements run outside of a request, e.g. by the session flusher, are not attributed to an endpoint
+    if 'metrics_start' in g:
+        g.metrics_sql_statements += 1
+        g.metrics_sql_seconds += seconds
+
+
+def before_template(sender, template, context, **extra):
+    g.metrics_template_start = time.perf_counter()
+
+
+def after_template(sender, template, context, **extra):
+    if 'metrics_template_start' in g:
+        g.metrics_template_seconds += time.perf_counter() - g.pop('metrics_template_start')
+
+
+def init_app(app):
+    """
+    Instrument every request when METRICS_ENABLED is set, and serve the results from /metrics to local clients.
+    With METRICS_TOKEN set, /metrics instead answers any client sending it as a bearer token, which is needed
+    behind a reverse proxy as every request then comes from the proxy's address.
+
+    When METRICS_PROFILE_THRESHOLD is set (in seconds) every request is run under cProfile, and the profiles of
+    requests that took at least that long are written to METRICS_PROFILE_DIR.
+    """
+    app.config.setdefault('METRICS_ENABLED', False)
+    app.config.setdefault('METRICS_PROFILE_THRESHOLD', None)
+    app.config.setdefault('METRICS_TOKEN', None)
+    app.config.setdefault('METRICS_PROFILE_DIR', os.path.join(app.instance_path, 'profiles'))
+
+    if not app.config['METRICS_ENABLED']:
+        return
+
+    profile_threshold = app.config['METRICS_PROFILE_THRESHOLD']
+    profile_dir = app.config['METRICS_PROFILE_DIR']
+    if profile_threshold is not None:
+        import cProfile
+        os.makedirs(profile_dir, exist_ok=True)
+
+    @app.before_request
+    def before_request():
+        start_request()
+        if profile_threshold is not None:
+            g.metrics_profiler = cProfile.Profile()
+            g.metrics_profiler.enable()
+
+    # Teardown runs after a streamed response has been sent, so streaming time is included
+    @app.teardown_request
+    def teardown_request(exception):
+        if 'metrics_start' in g:
+            finish_request(profile_threshold, profile_dir)
+
+    with app.app_context():
+        for engine in db.engines.values():
+            event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+            event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+
+    before_render_template.connect(before_template, app)
+    template_rendered.connect(after_template, app)
+
+    app.register_blueprint(metrics)
+
+
+@metrics.route('/metrics')
+def showMetrics():
+    token = current_app.config['METRICS_TOKEN']
+
+    if token is not None:
+        if not secrets.compare_digest(request.headers.get('Authorization', ''), f"Bearer {token}"):
+            abort(404)
+    # Otherwise only exposed to clients on this machine, e.g. a local Prometheus agent. Requests passed on by
+    # a proxy on this machine come from its address, the forwarding headers tell them apart.
+    elif request.remote_addr not in ('127.0.0.1', '::1') \
+            or any(header in request.headers for header in ('Forwarded', 'X-Forwarded-For', 'X-Real-IP')):
+        abort(404)
+
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
@@ -1,9 +1,73 @@
+import time
+from decimal import Decimal, InvalidOperation
+
 from . import db
 
+# The most an SQLite INTEGER column can hold
+MAX_PRICE_CENTS = 2 ** 63 - 1
+
+
+def parse_price(text):
+    """Price in cents from input like "$2.99", "2.99", "$.99" or "25", None if empty. Raises ValueError."""
+    text = text.strip().removeprefix('$').strip()
+
+    if not text:
+        return None
+
+    try:
+        amount = Decimal(text)
+        if not amount.is_finite() or amount < 0 or amount * 100 > MAX_PRICE_CENTS \
+                or amount != amount.quantize(Decimal('0.01')):
+            raise ValueError(f"invalid price {text!r}")
+    except InvalidOperation:
+        raise ValueError(f"invalid price {text!r}")
+
+    return int(amount * 100)
+
+
+def format_price(cents):
+    if cents is None:
+        return ''
+
+    return f"${cents // 100}.{cents % 100:02d}"
+
+
+def parse_menu_filters(args):
+    """
+    Menu filters from query string arguments: course, min_price and max_price in dollars, and sort=price to
+    order items by price instead of by id. Returns a dict of only the filters given. Raises ValueError.
+    """
+    filters = {}
+
+    if args.get('course'):
+        filters['course'] = args['course']
+
+    for name in ('min_price', 'max_price'):
+        cents = parse_price(args.get(name, ''))
+        if cents is not None:
+            filters[name] = cents
+
+    sort = args.get('sort', '')
+    if sort == 'price':
+        filters['sort'] = sort
+    elif sort not in ('', 'id'):
+        raise ValueError(f"invalid sort order {sort!r}")
+
+    return filters
+
 
 class Restaurant(db.Model):
+    # Keyset pagination of the restaurant list is ordered by (name, id)
+    __table_args__ = (db.Index('ix_restaurant_name_id', 'name', 'id'),)
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(250), nullable=False)
+    # Maintained by counters.adjust() so the restaurant list doesn't have to count rows
+    item_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    comment_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    updated_at = db.Column(db.Integer, default=lambda: int(time.time()))  # seconds since the epoch
+    items = db.relationship('MenuItem', order_by='MenuItem.id', viewonly=True)
+    comments = db.relationship('Comment', order_by='Comment.id', viewonly=True)
 
     @property
     def serialize(self):
@@ -15,14 +79,31 @@ class Restaurant(db.Model):
 
 
 class MenuItem(db.Model):
+    # Keyset pagination of a menu is ordered by id within a restaurant.
+    # This index also serves every lookup of a restaurant's items by restaurant_id.
+    # The second serves menus filtered by course and price range.
+    __table_args__ = (
+        db.Index('ix_menu_item_restaurant_id_id', 'restaurant_id', 'id'),
+        db.Index('ix_menu_item_restaurant_id_course_price', 'restaurant_id', 'course', 'price_cents'),
+    )
+
     name = db.Column(db.String(80), nullable=False)
     id = db.Column(db.Integer, primary_key=True)
     description = db.Column(db.String(250))
-    price = db.Column(db.String(8))
+    price_cents = db.Column(db.Integer)  # None for items without a price
     course = db.Column(db.String(250))
     restaurant_id = db.Column(db.Integer, db.ForeignKey('restaurant.id'))
     restaurant = db.relationship(Restaurant)
 
+    @property
+    def price(self):
+        """The price formatted for display, e.g. "$2.99" """
+        return format_price(self.price_cents)
+
+    @price.setter
+    def price(self, text):
+        self.price_cents = parse_price(text)
+
     @property
     def serialize(self):
         """Return object data in easily serializeable format"""
@@ -31,13 +112,14 @@ class MenuItem(db.Model):
             'description': self.description,
             'id': self.id,
             'price': self.price,
+            'price_cents': self.price_cents,
             'course': self.course,
         }
 
 
 class User(db.Model):
-    name = db.Column(db.String(50), nullable=False)
-    email = db.Column(db.String(50), nullable=False)
+    name = db.Column(db.String(50), nullable=False, unique=True, index=True)
+    email = db.Column(db.String(50), nullable=False, unique=True, index=True)
     id = db.Column(db.Integer, primary_key=True)
     password = db.Column(db.String(50), nullable=False)
     permission = db.Column(db.Integer, nullable=False)
@@ -59,8 +141,8 @@ class User(db.Model):
 
 class UserToken(db.Model):
     id = db.Column(db.Integer, nullable=False)
-    token = db.Column(db.String(50), nullable=False)
-    tolu = db.Column(db.Integer, nullable=False)
+    token = db.Column(db.String(50), nullable=False, unique=True, index=True)
+    tolu = db.Column(db.Integer, nullable=False, index=True)  # range scanned by SessionCache.sweep()
     uid = db.Column(db.Integer, primary_key=True)
     trusted = db.Column(db.Boolean, default=False)
 
@@ -79,7 +161,7 @@ class Comment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     description = db.Column(db.String(250), nullable=False)
     username = db.Column(db.Boolean(), default=True)
-    restaurantid = db.Column(db.Integer, db.ForeignKey('restaurant.id'))
+    restaurantid = db.Column(db.Integer, db.ForeignKey('restaurant.id'), index=True)
     restaurant = db.relationship(Restaurant)
     userid = db.Column(db.Integer, db.ForeignKey('user.id'))
     user = db.relationship(User)
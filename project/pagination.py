@@ -0,0 +1,77 @@
+import base64
+import binascii
+import json as pyjs
+
+from flask import abort, current_app, request, url_for
+
+#
+# Keyset pagination helpers. A page is requested with ?limit=<n>&cursor=<c>, where the cursor is an
+# opaque encoding of the sort key of the last row on the previous page.
+#
+
+
+def page_size():
+    return clamp_page_size(request.args.get('limit', type=int),
+                           current_app.config.get('PAGE_SIZE', 50), current_app.config.get('MAX_PAGE_SIZE', 200))
+
+
+def clamp_page_size(size, default, maximum):
+    if size is None or size < 1:
+        return default
+
+    return min(size, maximum)
+
+
+def encode_cursor(*values):
+    return base64.urlsafe_b64encode(pyjs.dumps(values).encode()).decode()
+
+
+def parse_cursor(cursor, *types):
+    """Returns the values of an encoded cursor, None if there is none. Raises ValueError if it is malformed."""
+    if not cursor:
+        return None
+
+    try:
+        values = pyjs.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, binascii.Error):
+        raise ValueError("malformed cursor")
+
+    if not isinstance(values, list) or len(values) != len(types) \
+            or not all(type(value) is kind for value, kind in zip(values, types)):
+        raise ValueError("malformed cursor")
+
+    # Ids and prices are SQLite integers, larger ints can't be bound
+    if any(type(value) is int and not -2 ** 63 <= value < 2 ** 63 for value in values):
+        raise ValueError("malformed cursor")
+
+    return values
+
+
+def decode_cursor(*types):
+    """Returns the values of the cursor in the request, None for the first page. Aborts on malformed cursors."""
+    try:
+        return parse_cursor(request.args.get('cursor'), *types)
+    except ValueError:
+        abort(400)
+
+
+def split_page(rows, size, key):
+    """
+    Split the size + 1 rows fetched for a page into the page itself and the cursor for the next page.
+    key returns the sort key values of a row.
+    """
+    if len(rows) <= size:
+        return rows, None
+
+    rows = rows[:size]
+    return rows, encode_cursor(*key(rows[-1]))
+
+
+def next_page_url(cursor):
+    if cursor is None:
+        return None
+
+    # Filters and the page size carry over to the next page
+    args = {name: value for name, value in request.args.items() if name not in request.view_args}
+    args['cursor'] = cursor
+    return url_for(request.endpoint, **request.view_args, **args)
@@ -0,0 +1,137 @@
+"""
+Pre-fork launcher running several waitress worker processes on one listening socket, so rendering and other
+Python work is spread over more than the one core a single process can use under the GIL:
+
+    python -m project.prefork --workers 4 --port 8000
+
+The parent binds the socket, forks the workers and restarts any that die. Each worker builds its own app after
+the fork. Every worker uses the same secret key, read once by the parent. The workers share cache invalidations
+through an SQLite file in the instance folder, see bus.py, and keep their rate limits in another. Unix only.
+"""
+import argparse
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+
+from flask import Flask
+
+
+def worker_config():
+    """Settings every worker is created with, on top of the usual configuration"""
+    app = Flask('project')
+    app.config.from_prefixed_env()
+
+    # Read like create_app() reads it, but once, so a key file replaced while running can't split the workers
+    secret_key = app.config.get('SECRET_KEY')
+    if secret_key is None:
+        with open("secret_key", "r") as secret_file:
+            secret_key = secret_file.readline()
+
+    os.makedirs(app.instance_path, exist_ok=True)
+    config = {
+        'SECRET_KEY': secret_key,
+        'INVALIDATION_BUS': app.config.get('INVALIDATION_BUS',
+                                           os.path.join(app.instance_path, 'invalidations.sqlite')),
+    }
+
+    # Limits counted in each worker's memory would multiply by the number of workers
+    if 'RATELIMIT_STORAGE' not in app.config:
+        config['RATELIMIT_STORAGE'] = 'sqlite'
+
+    return config
+
+
+def run_worker(sock, config, threads):
+    """Serve the app from a forked worker until it is told to stop. Never returns."""
+    from waitress import serve
+    from project import create_app
+    from project.templating import load_templates
+
+    status = 1
+    try:
+        # waitress stops cleanly on SystemExit and KeyboardInterrupt, so exit handlers like the session
+        # cache flush still run
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+
+        # Load the templates before taking requests, so the first visitors to a new worker don't wait for them
+        app = create_app(config)
+        load_templates(app)
+
+        serve(app, sockets=[sock], threads=threads)
+        status = 0
+    except (SystemExit, KeyboardInterrupt):
+        status = 0
+    except Exception:
+        logging.exception("Worker %d failed.", os.getpid())
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+    sys.exit(status)
+
+
+def serve_prefork(host, port, workers, threads):
+    if not hasattr(os, 'fork'):
+        raise SystemExit("The pre-fork server needs fork(), run waitress-serve with run.bat instead.")
+
+    sock = socket.create_server((host, port), backlog=2048)
+    config = worker_config()
+    children = set()
+    stopping = False
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            run_worker(sock, config, threads)
+        children.add(pid)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    for _ in range(workers):
+        spawn()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    logging.warning("Serving on http://%s:%d with %d workers", host, port, workers)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+
+        children.discard(pid)
+        if not stopping:
+            logging.warning("Worker %d exited with status %d, starting a new one.", pid,
+                            os.waitstatus_to_exitcode(status))
+            # Don't spin if workers die on startup
+            time.sleep(1)
+            spawn()
+
+    sock.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the restaurant app from several worker processes.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="worker processes (one per core)")
+    parser.add_argument('--threads', type=int, default=4, help="waitress threads per worker")
+    args = parser.parse_args(argv)
+
+    serve_prefork(args.host, args.port, args.workers, args.threads)
+
+
+if __name__ == '__main__':
+    main()
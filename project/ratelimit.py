@@ -0,0 +1,182 @@
+import functools
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from flask import request
+
+
+class RateLimited(Exception):
+    """Raised before a request does any work when its client or account has run out of attempts"""
+
+    def __init__(self, retry_after):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+
+def refill(tokens, updated, burst, rate, now):
+    """
+    Take one token from a bucket holding tokens at time updated, which refills at rate tokens per second up to
+    burst. Returns the tokens left and 0, or if the bucket is empty the tokens in it and the seconds until the
+    next token.
+    """
+    tokens = min(burst, tokens + (now - updated) * rate)
+
+    if tokens >= 1:
+        return tokens - 1, 0
+
+    return tokens, (1 - tokens) / rate
+
+
+class MemoryBuckets:
+    """Token buckets held in this process, the least recently used are dropped beyond max_size"""
+
+    def __init__(self, max_size=65536):
+        self.max_size = max_size
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, burst, rate, now):
+        """Take a token from the bucket for key. Returns 0 if there was one, otherwise the seconds to wait."""
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (burst, now))
+            tokens, wait = refill(tokens, updated, burst, rate, now)
+            self._buckets[key] = (tokens, now)
+
+            while len(self._buckets) > self.max_size:
+                self._buckets.popitem(last=False)
+
+        return wait
+
+
+class SQLiteBuckets:
+    """
+    Token buckets in an SQLite file, shared by every server process on the machine. Each take is one short
+    write transaction on a file of its own, so limiting never waits for the application database's write lock.
+    Buckets that have refilled are deleted every cleanup_interval takes, as a full bucket is the same as none.
+    """
+
+    def __init__(self, path, cleanup_interval=1000):
+        self.path = path
+        self.cleanup_interval = cleanup_interval
+        self._takes = 0
+        self._local = threading.local()
+
+    def take(self, key, burst, rate, now):
+        """Take a token from the bucket for key. Returns 0 if there was one, otherwise the seconds to wait."""
+        connection = self._connection()
+
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute("SELECT tokens, updated FROM bucket WHERE key = ?", (key,)).fetchone()
+            tokens, wait = refill(*(row or (burst, now)), burst, rate, now)
+            connection.execute("INSERT OR REPLACE INTO bucket (key, tokens, updated, full_at) VALUES (?, ?, ?, ?)",
+                               (key, tokens, now, now + (burst - tokens) / rate))
+
+            self._takes += 1
+            if self._takes % self.cleanup_interval == 0:
+                connection.execute("DELETE FROM bucket WHERE full_at < ?", (now,))
+
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+        return wait
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+
+        if connection is None:
+            # Autocommit mode, transactions are begun explicitly. Losing recent takes to a power cut is harmless.
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=OFF")
+            connection.execute("CREATE TABLE IF NOT EXISTS bucket (key TEXT PRIMARY KEY, tokens REAL NOT NULL, "
+                               "updated REAL NOT NULL, full_at REAL NOT NULL) WITHOUT ROWID")
+            self._local.connection = connection
+
+        return connection
+
+
+class RateLimiter:
+    """
+    Token bucket limits on attempts to sign in, sign up and confirm 2FA codes, per client IP address and per
+    account. A bucket holds up to burst attempts and regains rate attempts per second. Requests over either
+    limit fail with RateLimited before they look anything up or hash anything.
+
+    Buckets are kept in memory, or with RATELIMIT_STORAGE = 'sqlite' in a file shared by all server processes.
+    """
+
+    def __init__(self):
+        self.enabled = True
+        self.ip_limit = (30, 0.5)
+        self.account_limit = (5, 1 / 60)
+        self.storage = MemoryBuckets()
+        self.rejections = 0
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        app.config.setdefault('RATELIMIT_ENABLED', True)
+        app.config.setdefault('RATELIMIT_STORAGE', 'memory')
+        app.config.setdefault('RATELIMIT_SQLITE_PATH', os.path.join(app.instance_path, 'ratelimit.sqlite'))
+        app.config.setdefault('RATELIMIT_IP_BURST', 30)
+        app.config.setdefault('RATELIMIT_IP_RATE', 0.5)
+        app.config.setdefault('RATELIMIT_ACCOUNT_BURST', 5)
+        app.config.setdefault('RATELIMIT_ACCOUNT_RATE', 1 / 60)
+
+        if app.config['RATELIMIT_STORAGE'] == 'sqlite':
+            os.makedirs(os.path.dirname(app.config['RATELIMIT_SQLITE_PATH']), exist_ok=True)
+            storage = SQLiteBuckets(app.config['RATELIMIT_SQLITE_PATH'])
+        elif app.config['RATELIMIT_STORAGE'] == 'memory':
+            storage = MemoryBuckets()
+        else:
+            raise ValueError(f"Unknown RATELIMIT_STORAGE {app.config['RATELIMIT_STORAGE']!r}")
+
+        self.configure(app.config['RATELIMIT_ENABLED'], storage,
+                       (app.config['RATELIMIT_IP_BURST'], app.config['RATELIMIT_IP_RATE']),
+                       (app.config['RATELIMIT_ACCOUNT_BURST'], app.config['RATELIMIT_ACCOUNT_RATE']))
+
+    def configure(self, enabled, storage, ip_limit, account_limit):
+        self.enabled = enabled
+        self.storage = storage
+        self.ip_limit = ip_limit
+        self.account_limit = account_limit
+
+    def check(self, ip, account=None):
+        """Take an attempt from the client's and the account's buckets, raising RateLimited if either is empty"""
+        if not self.enabled:
+            return
+
+        now = time.time()
+        wait = self.storage.take('ip:' + ip, *self.ip_limit, now)
+        if not wait and account:
+            wait = self.storage.take('account:' + account, *self.account_limit, now)
+
+        if wait:
+            with self._lock:
+                self.rejections += 1
+            raise RateLimited(math.ceil(wait))
+
+
+rate_limiter = RateLimiter()
+
+
+def rate_limited(account=None):
+    """
+    Check the rate limits for POST requests to the decorated view before it runs. account is a function
+    returning the account a request acts on, if it names one.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method == 'POST':
+                rate_limiter.check(request.remote_addr or '', account() if account is not None else None)
+            return view(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
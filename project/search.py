@@ -0,0 +1,131 @@
+import re
+
+from sqlalchemy import bindparam, event, text
+
+from . import db
+
+#
+# Full text search over restaurants, menu items and comments with an SQLite FTS5 index.
+#
+# Every searchable row has one entry in search_index, kept up to date by triggers on the source tables, so
+# nothing needs to change in the views or in bulk inserts. An entry's rowid is the source row's id times
+# SEARCH_KINDS plus the kind of row, so triggers find it through the rowid instead of scanning the index.
+#
+
+SEARCH_KINDS = 4
+KIND_NAMES = {0: 'restaurant', 1: 'menu_item', 2: 'comment'}
+
+# rank orders results by bm25, where matches in titles (names) outrank matches in descriptions
+SEARCH_INDEX_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS search_index "
+    "USING fts5(title, body, restaurant_id UNINDEXED, tokenize = 'porter unicode61')",
+
+    "CREATE TRIGGER IF NOT EXISTS search_restaurant_insert AFTER INSERT ON restaurant BEGIN "
+    "INSERT INTO search_index (rowid, title, body, restaurant_id) VALUES (new.id * 4, new.name, '', new.id); END",
+    "CREATE TRIGGER IF NOT EXISTS search_restaurant_update AFTER UPDATE OF name ON restaurant BEGIN "
+    "UPDATE search_index SET title = new.name WHERE rowid = new.id * 4; END",
+    "CREATE TRIGGER IF NOT EXISTS search_restaurant_delete AFTER DELETE ON restaurant BEGIN "
+    "DELETE FROM search_index WHERE rowid = old.id * 4; END",
+
+    "CREATE TRIGGER IF NOT EXISTS search_menu_item_insert AFTER INSERT ON menu_item BEGIN "
+    "INSERT INTO search_index (rowid, title, body, restaurant_id) VALUES (new.id * 4 + 1, new.name, "
+    "coalesce(new.description, '') || ' ' || coalesce(new.course, ''), new.restaurant_id); END",
+    "CREATE TRIGGER IF NOT EXISTS search_menu_item_update "
+    "AFTER UPDATE OF name, description, course, restaurant_id ON menu_item BEGIN "
+    "UPDATE search_index SET title = new.name, body = coalesce(new.description, '') || ' ' || "
+    "coalesce(new.course, ''), restaurant_id = new.restaurant_id WHERE rowid = new.id * 4 + 1; END",
+    "CREATE TRIGGER IF NOT EXISTS search_menu_item_delete AFTER DELETE ON menu_item BEGIN "
+    "DELETE FROM search_index WHERE rowid = old.id * 4 + 1; END",
+
+    "CREATE TRIGGER IF NOT EXISTS search_comment_insert AFTER INSERT ON comment BEGIN "
+    "INSERT INTO search_index (rowid, title, body, restaurant_id) "
+    "VALUES (new.id * 4 + 2, new.title, new.description, new.restaurantid); END",
+    "CREATE TRIGGER IF NOT EXISTS search_comment_update AFTER UPDATE OF title, description, restaurantid ON comment "
+    "BEGIN UPDATE search_index SET title = new.title, body = new.description, restaurant_id = new.restaurantid "
+    "WHERE rowid = new.id * 4 + 2; END",
+    "CREATE TRIGGER IF NOT EXISTS search_comment_delete AFTER DELETE ON comment BEGIN "
+    "DELETE FROM search_index WHERE rowid = old.id * 4 + 2; END",
+)
+
+# Fills a new index from rows that were there before it
+SEARCH_INDEX_BUILD = (
+    "INSERT INTO search_index (search_index, rank) VALUES ('rank', 'bm25(10.0, 1.0)')",
+    "INSERT INTO search_index (rowid, title, body, restaurant_id) SELECT id * 4, name, '', id FROM restaurant",
+    "INSERT INTO search_index (rowid, title, body, restaurant_id) SELECT id * 4 + 1, name, "
+    "coalesce(description, '') || ' ' || coalesce(course, ''), restaurant_id FROM menu_item",
+    "INSERT INTO search_index (rowid, title, body, restaurant_id) "
+    "SELECT id * 4 + 2, title, description, restaurantid FROM comment",
+)
+
+
+def create_search_index(target, connection, **kw):
+    """Create the search index if it is missing, filling it from the existing rows. Runs after create_all()."""
+    if connection.dialect.name != 'sqlite':
+        return
+
+    exists = connection.execute(
+        text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'search_index'")).first()
+
+    for statement in SEARCH_INDEX_DDL:
+        connection.exec_driver_sql(statement)
+
+    if not exists:
+        for statement in SEARCH_INDEX_BUILD:
+            connection.exec_driver_sql(statement)
+
+
+def drop_search_index(target, connection, **kw):
+    """Drop the search index with its triggers. Runs before drop_all()."""
+    if connection.dialect.name != 'sqlite':
+        return
+
+    for table in ('restaurant', 'menu_item', 'comment'):
+        for action in ('insert', 'update', 'delete'):
+            connection.exec_driver_sql(f"DROP TRIGGER IF EXISTS search_{table}_{action}")
+    connection.exec_driver_sql("DROP TABLE IF EXISTS search_index")
+
+
+event.listen(db.metadata, 'after_create', create_search_index)
+event.listen(db.metadata, 'before_drop', drop_search_index)
+
+
+# Every match is ranked, FTS5 keeps only the best :limit while it scans them. Snippets would take too long for
+# terms matching most rows, so results show the indexed text.
+SEARCH = text(
+    "SELECT rowid, title, body, restaurant_id FROM search_index WHERE search_index MATCH :query "
+    "ORDER BY rank LIMIT :limit"
+).bindparams(bindparam('query'), bindparam('limit'))
+
+
+def match_query(terms):
+    """
+    Turn free text into an FTS5 query matching every word, the last one as a prefix so results show up while
+    typing. Returns None if there is nothing to search for.
+    """
+    words = re.findall(r'\w+', terms)
+
+    if not words:
+        return None
+
+    return ' '.join(f'"{word}"' for word in words) + '*'
+
+
+def search(terms, limit):
+    """
+    The best matches for the search terms, as dicts with the kind and id of the matching row, the id of its
+    restaurant, its title and the rest of its indexed text.
+    """
+    query = match_query(terms)
+
+    if query is None:
+        return []
+
+    rows = db.session.execute(SEARCH, {'query': query, 'limit': limit})
+
+    return [{
+        'type': KIND_NAMES[row.rowid % SEARCH_KINDS],
+        'id': row.rowid // SEARCH_KINDS,
+        'restaurant_id': row.restaurant_id,
+        'title': row.title,
+        'text': row.body,
+    } for row in rows]
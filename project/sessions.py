@@ -0,0 +1,203 @@
+import atexit
+import hashlib
+import logging
+import threading
+import time
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import bindparam, select
+
+from . import db
+from .bus import invalidation_bus
+from .cache import LRUCache
+from .models import UserToken
+
+TOKEN_LIFETIME = 2592000  # One month token expiry period
+
+
+def token_digest(token):
+    """The key of a token in the cache. Invalidations carry only this, never a usable token."""
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+class CachedToken:
+    """The parts of a UserToken row needed to resolve a session without querying the database"""
+
+    __slots__ = ('user_id', 'trusted', 'tolu', 'written')
+
+    def __init__(self, user_id, trusted, tolu):
+        self.user_id = user_id
+        self.trusted = trusted
+        self.tolu = tolu
+        self.written = tolu
+
+
+class SessionCache:
+    """
+    Caches token -> user lookups in memory and batches "time of last use" updates.
+
+    Instead of committing a new tolu on every request, touch() records the time in memory and
+    a background thread writes all pending times in a single transaction every SESSION_TOUCH_INTERVAL
+    seconds, so each token is written at most once per interval.
+
+    The same thread deletes expired tokens every SESSION_SWEEP_INTERVAL seconds, see sweep().
+    """
+
+    def __init__(self):
+        self.tokens = LRUCache(max_size=4096, ttl=300)
+        self.touch_interval = 60
+        self.sweep_interval = 3600
+        self.sweep_batch_size = 1000
+        self.resolutions = 0
+        self.reclaimed = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def init_app(self, app):
+        app.config.setdefault('SESSION_CACHE_SIZE', 4096)
+        app.config.setdefault('SESSION_CACHE_TTL', 300)
+        app.config.setdefault('SESSION_TOUCH_INTERVAL', 60)
+        app.config.setdefault('SESSION_SWEEP_INTERVAL', 3600)
+        app.config.setdefault('SESSION_SWEEP_BATCH_SIZE', 1000)
+        app.config.setdefault('SESSION_FLUSH_THREAD', True)
+
+        self.tokens.configure(max_size=app.config['SESSION_CACHE_SIZE'], ttl=app.config['SESSION_CACHE_TTL'])
+        self.touch_interval = app.config['SESSION_TOUCH_INTERVAL']
+        self.sweep_interval = app.config['SESSION_SWEEP_INTERVAL']
+        self.sweep_batch_size = app.config['SESSION_SWEEP_BATCH_SIZE']
+
+        app.cli.add_command(sweep_tokens_command)
+
+        if app.config['SESSION_FLUSH_THREAD'] and self._thread is None:
+            self._thread = threading.Thread(target=self._run, args=(app,), name='session-flusher', daemon=True)
+            self._thread.start()
+            atexit.register(self._flush_on_exit, app)
+
+    def lookup(self, token):
+        return self.tokens.get(token_digest(token))
+
+    def store(self, token_object: UserToken) -> CachedToken:
+        cached = CachedToken(token_object.id, token_object.trusted, token_object.tolu)
+
+        # A pending write is always newer than the row we just read
+        with self._lock:
+            pending = self._pending.get(token_object.token)
+        if pending is not None and pending > cached.tolu:
+            cached.tolu = pending
+
+        self.tokens.set(token_digest(token_object.token), cached)
+        return cached
+
+    def touch(self, token, cached: CachedToken, now):
+        cached.tolu = now
+
+        if now - cached.written < self.touch_interval:
+            return
+
+        cached.written = now
+        with self._lock:
+            self._pending[token] = now
+
+    def invalidate(self, token):
+        """Forget a token here and, with the invalidation bus, in every other worker"""
+        digest = token_digest(token)
+        invalidation_bus.publish('session', digest)
+
+        self.tokens.pop(digest)
+        with self._lock:
+            self._pending.pop(token, None)
+
+    def forget(self, digest):
+        """Drop a token invalidated by another worker. Its pending time of last use only updates rows that exist."""
+        self.tokens.pop(digest)
+
+    def flush(self):
+        """Write all pending tolu updates in one transaction. Must be called within an app context."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+
+        if not pending:
+            return 0
+
+        table = UserToken.__table__
+        statement = table.update().where(table.c.token == bindparam('b_token')).values(tolu=bindparam('b_tolu'))
+        db.session.execute(statement, [{'b_token': token, 'b_tolu': tolu} for token, tolu in pending.items()])
+        db.session.commit()
+
+        return len(pending)
+
+    def sweep(self, now=None):
+        """
+        Delete every token unused for TOKEN_LIFETIME, committing after each batch of sweep_batch_size rows
+        so the write lock is never held for long. Must be called within an app context.
+        """
+        # Pending times of last use are newer than the rows, write them first so no live token is swept
+        self.flush()
+
+        cutoff = int(time.time() if now is None else now) - TOKEN_LIFETIME
+        table = UserToken.__table__
+        expired = select(table.c.uid).where(table.c.tolu < cutoff).limit(self.sweep_batch_size)
+        statement = table.delete().where(table.c.uid.in_(expired.scalar_subquery()))
+
+        deleted = 0
+        while True:
+            count = db.session.execute(statement).rowcount
+            db.session.commit()
+            deleted += count
+            if count < self.sweep_batch_size:
+                break
+
+        with self._lock:
+            self.reclaimed += deleted
+
+        return deleted
+
+    def clear(self):
+        self.tokens.clear()
+        with self._lock:
+            self._pending.clear()
+
+    def _run(self, app):
+        next_sweep = time.monotonic()
+
+        while not self._stop.wait(max(self.touch_interval, 1)):
+            self._flush_in_context(app)
+
+            if self.sweep_interval and time.monotonic() >= next_sweep:
+                next_sweep = time.monotonic() + self.sweep_interval
+                self._sweep_in_context(app)
+
+    def _flush_on_exit(self, app):
+        self._stop.set()
+        self._flush_in_context(app)
+
+    def _flush_in_context(self, app):
+        with app.app_context():
+            try:
+                self.flush()
+            except Exception:
+                logging.exception("Failed to flush session token updates.")
+                db.session.rollback()
+
+    def _sweep_in_context(self, app):
+        with app.app_context():
+            try:
+                self.sweep()
+            except Exception:
+                logging.exception("Failed to sweep expired session tokens.")
+                db.session.rollback()
+
+
+session_cache = SessionCache()
+invalidation_bus.subscribe('session', session_cache.forget)
+invalidation_bus.subscribe('reset', session_cache.tokens.clear)
+
+
+@click.command('sweep-tokens')
+@with_appcontext
+def sweep_tokens_command():
+    """Delete expired session tokens."""
+    click.echo(f"Deleted {session_cache.sweep()} expired session tokens.")
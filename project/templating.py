@@ -0,0 +1,43 @@
+import os
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from jinja2 import FileSystemBytecodeCache
+
+#
+# Templates compiled to Python bytecode are kept on disk, so a freshly started server process loads each template
+# instead of parsing and compiling it during its first requests. The precompile-templates command fills the cache
+# when the site is deployed. Jinja compares every cached template against its source, so templates changed since
+# are compiled again on first use.
+#
+
+
+def init_app(app):
+    app.config.setdefault('TEMPLATE_BYTECODE_CACHE', os.path.join(app.instance_path, 'template_cache'))
+
+    directory = app.config['TEMPLATE_BYTECODE_CACHE']
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory)
+
+    app.cli.add_command(precompile_templates_command)
+
+
+def load_templates(app):
+    """Load every template into the app's template cache, compiling those missing from the bytecode cache"""
+    names = app.jinja_env.list_templates()
+    for name in names:
+        app.jinja_env.get_template(name)
+
+    return len(names)
+
+
+@click.command('precompile-templates')
+@with_appcontext
+def precompile_templates_command():
+    """Compile every template into the template bytecode cache."""
+    if current_app.jinja_env.bytecode_cache is None:
+        raise click.ClickException("TEMPLATE_BYTECODE_CACHE is not set.")
+
+    click.echo(f"Compiled {load_templates(current_app)} templates.")
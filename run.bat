@@ -1 +1,2 @@
+flask --app project precompile-templates
 waitress-serve --host 127.0.0.1 --port 8000 --call project:create_app
\ No newline at end of file
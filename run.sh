@@ -1,2 +1,3 @@
 #!/usr/bin/env sh
+flask --app project precompile-templates &&
 waitress-serve --host 127.0.0.1 --port 8000 --call project:create_app
\ No newline at end of file
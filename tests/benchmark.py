@@ -0,0 +1,505 @@
+"""
+In-process benchmarks for the restaurant app, run against seeded temporary databases.
+
+Run from the repository root, for example:
+
+    python -m tests.benchmark requests --restaurants 1000 --items 50 --comments 10 --output results.json
+    python -m tests.benchmark requests --compare results.json
+    python -m tests.benchmark json-memory --sizes 1000 10000 100000
+    python -m tests.benchmark statements --iterations 20000
+    python -m tests.benchmark prefork --workers 1 2 4 --seconds 10
+    python -m tests.benchmark startup --runs 20
+
+Each result is printed as one JSON object per line.
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import signal
+import socket
+import subprocess
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+
+def benchmark_app(directory, **config):
+    from project import create_app
+
+    settings = {
+        'TESTING': True,
+        'SECRET_KEY': 'benchmark',
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(directory, 'benchmark.db'),
+        'SESSION_FLUSH_THREAD': False,
+        # Every simulated client posts from 127.0.0.1, measure the views rather than the 429 responses
+        'RATELIMIT_ENABLED': False,
+        'TEMPLATE_BYTECODE_CACHE': os.path.join(directory, 'template_cache'),
+    }
+    settings.update(config)
+
+    return create_app(settings)
+
+
+def seed(app, restaurants, items, comments, users):
+    """Fill the app's database with synthetic data, see initialise_db.generate_synthetic_data()"""
+    from project import db
+    from initialise_db import generate_synthetic_data
+
+    with app.app_context(), contextlib.redirect_stdout(sys.stderr):
+        db.create_all()
+        generate_synthetic_data(restaurants, items, comments, users)
+
+
+def emit(result):
+    print(json.dumps(result), flush=True)
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+#
+# Request benchmarks
+#
+# Each scenario is a (setup, request) pair of functions taking a test client and a random generator.
+# request makes one request and returns the response, setup prepares each client, e.g. by logging in.
+#
+
+def login(client, rng, users):
+    user = rng.randint(1, users)
+    return client.post("/login/", data={"email": f"user{user}@example.com", "password": "password"})
+
+
+def scenarios(args):
+    def restaurant_id(rng):
+        return rng.randint(1, args.restaurants)
+
+    def item_id(rng):
+        return rng.randint(1, args.restaurants * args.items)
+
+    def post_comment(client, rng):
+        return client.post(f"/restaurant/{restaurant_id(rng)}/comment/new/",
+                           data={"title": "Benchmark", "description": "A comment posted by the benchmark"})
+
+    return {
+        'showRestaurants': (None, lambda client, rng: client.get("/restaurant/")),
+        'showMenu': (None, lambda client, rng: client.get(f"/restaurant/{restaurant_id(rng)}/menu/")),
+        'restaurantsJSON': (None, lambda client, rng: client.get("/restaurant/JSON")),
+        'restaurantMenuJSON': (None, lambda client, rng: client.get(f"/restaurant/{restaurant_id(rng)}/menu/JSON")),
+        'menuItemJSON': (None, lambda client, rng: client.get(f"/restaurant/1/menu/{item_id(rng)}/JSON")),
+        'showLogin': (None, lambda client, rng: login(client, rng, args.users)),
+        'newComment': (lambda client, rng: login(client, rng, args.users), post_comment),
+    }
+
+
+SCENARIOS = list(scenarios(argparse.Namespace()))
+
+
+def run_scenario(app, name, setup, request, requests, args):
+    """Make the given number of requests spread over args.threads clients and summarise their latencies"""
+    latencies = []
+    lock = threading.Lock()
+
+    def worker(index, count):
+        rng = random.Random(args.seed + index)
+        client = app.test_client()
+        if setup is not None:
+            setup(client, rng).close()
+
+        samples = []
+        for _ in range(count):
+            start = time.perf_counter()
+            with request(client, rng) as response:
+                response.get_data()
+            samples.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                raise RuntimeError(f"{name} returned {response.status_code}")
+
+        with lock:
+            latencies.extend(samples)
+
+    shares = [requests // args.threads + (1 if i < requests % args.threads else 0) for i in range(args.threads)]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        for future in [executor.submit(worker, i, count) for i, count in enumerate(shares)]:
+            future.result()
+    elapsed = time.perf_counter() - start
+
+    return {
+        'benchmark': 'requests',
+        'scenario': name,
+        'requests': len(latencies),
+        'threads': args.threads,
+        'throughput': round(len(latencies) / elapsed, 2),
+        'mean_ms': round(statistics.mean(latencies) * 1000, 3),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+    }
+
+
+def compare(results, baseline_path, tolerance):
+    """Print the scenarios whose p50 or p99 latency regressed beyond tolerance. Returns True if any did."""
+    with open(baseline_path) as baseline_file:
+        baseline = {result['scenario']: result for result in json.load(baseline_file)['results']}
+
+    regressed = False
+    for result in results:
+        before = baseline.get(result['scenario'])
+        if before is None:
+            continue
+
+        for metric in ('p50_ms', 'p99_ms'):
+            if result[metric] > before[metric] * (1 + tolerance):
+                regressed = True
+                print(f"REGRESSION {result['scenario']} {metric}: {before[metric]} -> {result[metric]}",
+                      file=sys.stderr)
+
+    return regressed
+
+
+def request_benchmarks(args):
+    """Throughput and latency percentiles of the main pages, JSON endpoints, login and comment posting"""
+    all_scenarios = scenarios(args)
+
+    config = {}
+    if args.no_page_cache:
+        config.update(PAGE_CACHE_SIZE=0, MENU_CACHE_SIZE=0)
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        app = benchmark_app(directory, **config)
+        seed(app, args.restaurants, args.items, args.comments, args.users)
+
+        for name in args.scenarios or SCENARIOS:
+            setup, request = all_scenarios[name]
+
+            # Warm up caches and compiled statements before measuring
+            run_scenario(app, name, setup, request, args.threads, args)
+
+            result = run_scenario(app, name, setup, request, args.requests, args)
+            emit(result)
+            results.append(result)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump({
+                'config': {key: value for key, value in vars(args).items() if key != 'run'},
+                'python': platform.python_version(),
+                'results': results,
+            }, output_file, indent=2)
+
+    if args.compare and compare(results, args.compare, args.tolerance):
+        return 1
+
+    return 0
+
+
+def json_memory(args):
+    """Peak Python memory while streaming a whole menu from restaurantMenuJSON"""
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            app = benchmark_app(directory, MAX_PAGE_SIZE=size)
+            seed(app, restaurants=1, items=size, comments=0, users=1)
+            client = app.test_client()
+            url = f"/restaurant/1/menu/JSON?limit={size}"
+
+            # Warm up so one-off costs like statement compilation are not measured
+            client.get(url).close()
+
+            tracemalloc.start()
+            start = time.perf_counter()
+
+            response = client.get(url, buffered=False)
+            length = sum(len(chunk) for chunk in response.response)
+            response.close()
+
+            elapsed = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            emit({'benchmark': 'json-memory', 'items': size, 'bytes': length, 'peak_memory': peak,
+                  'seconds': round(elapsed, 4)})
+
+    return 0
+
+
+def statement_overhead(args):
+    """Per-call cost of the json blueprint's queries as per-call text(), precompiled, and precompiled uncached"""
+    from sqlalchemy import text
+    from project import db
+    from project.json import MENU_ITEM, MENU_PAGE
+
+    menu_item_text = 'select * from menu_item where id = :menu_id limit 1'
+    menu_page_text = 'select * from menu_item where restaurant_id = :restaurant_id and id > :after order by id limit :limit'
+
+    variants = {
+        'text': (lambda: text(menu_item_text), lambda: text(menu_page_text), {}),
+        'precompiled': (lambda: MENU_ITEM, lambda: MENU_PAGE, {}),
+        'precompiled-uncached': (lambda: MENU_ITEM, lambda: MENU_PAGE, {'compiled_cache': None}),
+    }
+
+    with tempfile.TemporaryDirectory() as directory:
+        app = benchmark_app(directory)
+        seed(app, restaurants=100, items=10, comments=0, users=1)
+
+        with app.app_context():
+            for variant, (menu_item, menu_page, options) in variants.items():
+                queries = {
+                    'menuItemJSON': (menu_item, lambda rng: {'menu_id': rng.randint(1, 1000)}),
+                    'restaurantMenuJSON': (menu_page, lambda rng: {'restaurant_id': rng.randint(1, 100),
+                                                                   'after': 0, 'limit': 50}),
+                }
+
+                with db.engine.connect() as connection:
+                    connection.execution_options(**options)
+
+                    for query, (statement, params) in queries.items():
+                        rng = random.Random(args.seed)
+                        connection.execute(statement(), params(rng)).all()
+
+                        start = time.perf_counter()
+                        for _ in range(args.iterations):
+                            connection.execute(statement(), params(rng)).all()
+                        elapsed = time.perf_counter() - start
+
+                        emit({'benchmark': 'statements', 'query': query, 'variant': variant,
+                              'iterations': args.iterations,
+                              'us_per_call': round(elapsed / args.iterations * 1e6, 2)})
+
+    return 0
+
+
+#
+# Pre-fork scaling
+#
+# The server runs as a separate process group, python -m project.prefork, and is loaded over HTTP by client
+# processes so that neither the server nor the load is held back by the benchmark's own GIL.
+#
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_server(port, timeout=30):
+    import http.client
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            connection.request('GET', '/restaurant/')
+            if connection.getresponse().status == 200:
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"The server on port {port} did not start")
+
+
+def worker_counts():
+    """1, 2, 4... up to the number of cores, and the number of cores"""
+    cpus = os.cpu_count() or 1
+    counts = [1]
+    while counts[-1] * 2 <= cpus:
+        counts.append(counts[-1] * 2)
+    if counts[-1] != cpus:
+        counts.append(cpus)
+
+    return counts
+
+
+def load_client(port, path, seconds):
+    """Request path over one keep-alive connection for the given time. Returns the number of responses."""
+    import http.client
+
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    count = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        connection.request('GET', path)
+        response = connection.getresponse()
+        response.read()
+        if response.status != 200:
+            raise RuntimeError(f"{path} returned {response.status}")
+        count += 1
+
+    return count
+
+
+def prefork_scaling(args):
+    """Throughput of showRestaurants from the pre-fork server as the number of worker processes grows"""
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    baseline = None
+    with tempfile.TemporaryDirectory() as directory:
+        seed(benchmark_app(directory), args.restaurants, 0, 0, 1)
+
+        env = dict(os.environ,
+                   FLASK_SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.join(directory, 'benchmark.db'),
+                   FLASK_SECRET_KEY='benchmark',
+                   FLASK_INVALIDATION_BUS=os.path.join(directory, 'invalidations.sqlite'),
+                   FLASK_RATELIMIT_SQLITE_PATH=os.path.join(directory, 'ratelimit.sqlite'))
+        if args.no_page_cache:
+            env['FLASK_PAGE_CACHE_SIZE'] = '0'
+
+        path = f"/restaurant/?limit={args.page_size}"
+        for workers in args.workers:
+            port = free_port()
+            server = subprocess.Popen([sys.executable, '-m', 'project.prefork', '--workers', str(workers),
+                                       '--threads', str(args.threads), '--port', str(port)],
+                                      env=env, stderr=subprocess.DEVNULL, start_new_session=True)
+            try:
+                wait_for_server(port)
+                clients = args.clients or 2 * workers
+                with ProcessPoolExecutor(clients, mp_context=multiprocessing.get_context('spawn')) as pool:
+                    # Warm up every worker's caches and compiled statements before measuring
+                    list(pool.map(load_client, [port] * clients, [path] * clients, [1] * clients))
+                    counts = list(pool.map(load_client, [port] * clients, [path] * clients, [args.seconds] * clients))
+            finally:
+                os.killpg(server.pid, signal.SIGTERM)
+                server.wait()
+
+            throughput = sum(counts) / args.seconds
+            baseline = baseline or throughput
+            emit({'benchmark': 'prefork', 'scenario': 'showRestaurants', 'workers': workers, 'clients': clients,
+                  'throughput': round(throughput, 1), 'speedup': round(throughput / baseline, 2),
+                  'efficiency': round(throughput / baseline / workers, 2), 'cpus': os.cpu_count()})
+
+    return 0
+
+
+#
+# Startup time
+#
+# Every run is a fresh interpreter, which imports the app, creates it and makes its first requests, so nothing is
+# shared with the benchmark process or earlier runs but the database and the template bytecode cache.
+#
+
+STARTUP_SCRIPT = """
+import json, sys, time
+
+start = time.perf_counter()
+from project import create_app
+imported = time.perf_counter()
+app = create_app(json.loads(sys.argv[1]))
+created = time.perf_counter()
+
+client = app.test_client()
+requests = {}
+for path in sys.argv[2:]:
+    before = time.perf_counter()
+    if client.get(path).status_code != 200:
+        sys.exit(path + " failed")
+    requests[path] = time.perf_counter() - before
+
+print(json.dumps({'import': imported - start, 'create_app': created - imported, 'requests': requests,
+                  'modules': len(sys.modules)}))
+"""
+
+STARTUP_PATHS = ['/restaurant/', '/restaurant/1/menu/', '/login/', '/signup/']
+
+
+def startup_time(args):
+    """Import, create_app and first request times of fresh processes, with and without precompiled templates"""
+    from project.templating import load_templates
+
+    with tempfile.TemporaryDirectory() as directory:
+        seed(benchmark_app(directory), 10, 10, 1, 1)
+
+        config = {
+            'SECRET_KEY': 'benchmark',
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(directory, 'benchmark.db'),
+            'SESSION_FLUSH_THREAD': False,
+        }
+        variants = {
+            'no cache': dict(config, TEMPLATE_BYTECODE_CACHE=None),
+            'precompiled': dict(config, TEMPLATE_BYTECODE_CACHE=os.path.join(directory, 'template_cache')),
+        }
+        load_templates(benchmark_app(directory, **variants['precompiled']))
+
+        for variant, settings in variants.items():
+            runs = []
+            for _ in range(args.runs):
+                before = time.perf_counter()
+                output = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT, json.dumps(settings), *STARTUP_PATHS],
+                                        capture_output=True, text=True, check=True).stdout
+                run = json.loads(output)
+                run['process'] = time.perf_counter() - before
+                runs.append(run)
+
+            def median_ms(samples):
+                return round(statistics.median(samples) * 1000, 1)
+
+            emit({'benchmark': 'startup', 'variant': variant, 'runs': args.runs,
+                  'process_ms': median_ms([run['process'] for run in runs]),
+                  'import_ms': median_ms([run['import'] for run in runs]),
+                  'create_app_ms': median_ms([run['create_app'] for run in runs]),
+                  'first_requests_ms': {path: median_ms([run['requests'][path] for run in runs])
+                                        for path in STARTUP_PATHS},
+                  'modules': runs[0]['modules']})
+
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    benchmarks = parser.add_subparsers(dest='benchmark', required=True)
+
+    parser_requests = benchmarks.add_parser('requests', help=request_benchmarks.__doc__)
+    parser_requests.add_argument('--restaurants', type=int, default=1000)
+    parser_requests.add_argument('--items', type=int, default=20, help="menu items per restaurant")
+    parser_requests.add_argument('--comments', type=int, default=5, help="comments per restaurant")
+    parser_requests.add_argument('--users', type=int, default=100)
+    parser_requests.add_argument('--requests', type=int, default=500, help="requests per scenario")
+    parser_requests.add_argument('--threads', type=int, default=1, help="concurrent clients per scenario")
+    parser_requests.add_argument('--scenarios', nargs='+', choices=SCENARIOS)
+    parser_requests.add_argument('--no-page-cache', action='store_true', help="disable the rendered page caches")
+    parser_requests.add_argument('--seed', type=int, default=3310, help="random seed for the requested ids")
+    parser_requests.add_argument('--output', help="write all results and the configuration to this JSON file")
+    parser_requests.add_argument('--compare', metavar='BASELINE',
+                                 help="exit with status 1 if latencies regressed against a previous --output file")
+    parser_requests.add_argument('--tolerance', type=float, default=0.2,
+                                 help="allowed latency increase over the baseline, as a fraction")
+    parser_requests.set_defaults(run=request_benchmarks)
+
+    parser_json_memory = benchmarks.add_parser('json-memory', help=json_memory.__doc__)
+    parser_json_memory.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser_json_memory.set_defaults(run=json_memory)
+
+    parser_statements = benchmarks.add_parser('statements', help=statement_overhead.__doc__)
+    parser_statements.add_argument('--iterations', type=int, default=10000)
+    parser_statements.add_argument('--seed', type=int, default=3310)
+    parser_statements.set_defaults(run=statement_overhead)
+
+    parser_prefork = benchmarks.add_parser('prefork', help=prefork_scaling.__doc__)
+    parser_prefork.add_argument('--workers', type=int, nargs='+', default=worker_counts(),
+                                help="worker counts to measure (powers of two up to the number of cores)")
+    parser_prefork.add_argument('--threads', type=int, default=4, help="waitress threads per worker")
+    parser_prefork.add_argument('--clients', type=int, help="concurrent client processes (twice the workers)")
+    parser_prefork.add_argument('--seconds', type=float, default=10, help="measured time per worker count")
+    parser_prefork.add_argument('--restaurants', type=int, default=1000)
+    parser_prefork.add_argument('--page-size', type=int, default=50, help="restaurants per listing page")
+    parser_prefork.add_argument('--no-page-cache', action='store_true', help="render every page")
+    parser_prefork.set_defaults(run=prefork_scaling)
+
+    parser_startup = benchmarks.add_parser('startup', help=startup_time.__doc__)
+    parser_startup.add_argument('--runs', type=int, default=10, help="processes started per variant")
+    parser_startup.set_defaults(run=startup_time)
+
+    args = parser.parse_args(argv)
+    return args.run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
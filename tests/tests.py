@@ -1,3 +1,5 @@
+import asyncio
+import importlib.util
 import unittest
 
 #
@@ -77,3 +79,1479 @@ class SecurityTestCases(unittest.TestCase):
         self.assertEqual(r.status_code, 200)
         self.assertNotIn("New Restaurant new test restaurant Created", r.text)
 
+
+class AppTestCase(unittest.TestCase):
+    """
+    Runs the application in-process against a temporary database, no server required.
+    """
+
+    def setUp(self):
+        import tempfile
+
+        from project import create_app, db
+        from project.main import menu_cache, page_cache, qr_cache
+        from project.sessions import session_cache
+
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.app = create_app(self.appConfig())
+        session_cache.clear()
+        menu_cache.clear()
+        page_cache.clear()
+        qr_cache.clear()
+
+        with self.app.app_context():
+            db.create_all()
+
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        from project import db
+
+        with self.app.app_context():
+            db.engine.dispose()
+        self.tmpdir.cleanup()
+
+    def appConfig(self):
+        import os
+
+        return {
+            'TESTING': True,
+            'SECRET_KEY': 'testing',
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(self.tmpdir.name, 'test.db'),
+            'SESSION_FLUSH_THREAD': False,
+            'PASSWORD_HASH_WORKERS': 0,
+            'TEMPLATE_BYTECODE_CACHE': os.path.join(self.tmpdir.name, 'template_cache'),
+        }
+
+    def createUser(self, name="tester", email="tester@example.com", password="password"):
+        from werkzeug import security
+        from project import db
+        from project.models import User
+
+        with self.app.app_context():
+            user = User(name=name, email=email, permission=0,
+                        password=security.generate_password_hash(password, method="scrypt"))
+            db.session.add(user)
+            db.session.commit()
+            return user.id
+
+    def createRestaurant(self, name="Test Restaurant"):
+        from project import db
+        from project.models import Restaurant
+
+        with self.app.app_context():
+            restaurant = Restaurant(name=name)
+            db.session.add(restaurant)
+            db.session.commit()
+            return restaurant.id
+
+    def login(self, email="tester@example.com", password="password"):
+        return self.client.post("/login/", data={"email": email, "password": password})
+
+    def countStatements(self, prefix):
+        """Returns a list that collects every SQL statement starting with prefix until the test ends"""
+        from sqlalchemy import event
+        from project import db
+
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            if statement.lstrip().upper().startswith(prefix):
+                statements.append(statement)
+
+        with self.app.app_context():
+            engine = db.engine
+        event.listen(engine, "before_cursor_execute", before_cursor_execute)
+        self.addCleanup(event.remove, engine, "before_cursor_execute", before_cursor_execute)
+
+        return statements
+
+
+class SessionCacheTestCases(AppTestCase):
+
+    def testPageViewsDoNotWriteTokens(self):
+        self.createUser()
+        self.login()
+
+        updates = self.countStatements("UPDATE")
+        for _ in range(5):
+            r = self.client.get("/restaurant/")
+            self.assertEqual(r.status_code, 200)
+            self.assertIn("tester", r.text)
+
+        self.assertEqual(updates, [])
+
+    def testTouchesAreFlushedInOneBatch(self):
+        from project import db
+        from project.models import UserToken
+        from project.sessions import session_cache
+
+        self.createUser()
+        self.login()
+        session_cache.touch_interval = 0
+
+        self.client.get("/restaurant/")
+        self.client.get("/restaurant/")
+
+        updates = self.countStatements("UPDATE")
+        with self.app.app_context():
+            self.assertEqual(session_cache.flush(), 1)
+            self.assertEqual(len(updates), 1)
+            self.assertEqual(db.session.query(UserToken).count(), 1)
+
+    def testLogoutInvalidatesCachedToken(self):
+        self.createUser()
+        self.login()
+
+        with self.client.session_transaction() as flask_session:
+            token = flask_session["token"]
+        self.assertIn("tester", self.client.get("/restaurant/").text)
+
+        self.client.post("/logout/")
+        with self.client.session_transaction() as flask_session:
+            flask_session["token"] = token
+
+        self.assertNotIn("tester", self.client.get("/restaurant/").text)
+
+    def testExpiredTokenIsDeleted(self):
+        from project import db
+        from project.models import UserToken
+        from project.sessions import TOKEN_LIFETIME
+
+        self.createUser()
+        self.login()
+
+        with self.app.app_context():
+            db.session.query(UserToken).update({UserToken.tolu: UserToken.tolu - TOKEN_LIFETIME - 1})
+            db.session.commit()
+
+        self.assertNotIn("tester", self.client.get("/restaurant/").text)
+        with self.app.app_context():
+            self.assertEqual(db.session.query(UserToken).count(), 0)
+
+
+    def testSweepDeletesExpiredTokensInBatches(self):
+        import time
+        from project import db
+        from project.models import UserToken
+        from project.sessions import session_cache, TOKEN_LIFETIME
+
+        expired = int(time.time()) - TOKEN_LIFETIME - 1
+        with self.app.app_context():
+            db.session.add_all(UserToken(id=1, token=f"expired{i}", tolu=expired) for i in range(25))
+            db.session.add(UserToken(id=1, token="live", tolu=int(time.time())))
+            db.session.commit()
+
+        session_cache.sweep_batch_size = 10
+        reclaimed = session_cache.reclaimed
+        deletes = self.countStatements("DELETE")
+        with self.app.app_context():
+            self.assertEqual(session_cache.sweep(), 25)
+            self.assertEqual([token.token for token in db.session.query(UserToken)], ["live"])
+        self.assertEqual(len(deletes), 3)
+        self.assertEqual(session_cache.reclaimed, reclaimed + 25)
+
+    def testSweepKeepsRecentlyUsedTokens(self):
+        from project import db
+        from project.models import UserToken
+        from project.sessions import session_cache, TOKEN_LIFETIME
+
+        self.createUser()
+        self.login()
+        self.client.get("/restaurant/")
+        session_cache.touch_interval = 0
+
+        # The row looks expired, but the token is used again and that is still waiting to be written
+        with self.app.app_context():
+            db.session.query(UserToken).update({UserToken.tolu: UserToken.tolu - TOKEN_LIFETIME - 1})
+            db.session.commit()
+        self.client.get("/restaurant/")
+
+        with self.app.app_context():
+            self.assertEqual(session_cache.sweep(), 0)
+        self.assertIn("tester", self.client.get("/restaurant/").text)
+
+    def testSweepCommand(self):
+        from project import db
+        from project.models import UserToken
+
+        with self.app.app_context():
+            db.session.add(UserToken(id=1, token="expired", tolu=0))
+            db.session.commit()
+
+        result = self.app.test_cli_runner().invoke(args=["sweep-tokens"])
+        self.assertIn("Deleted 1 expired session tokens.", result.output)
+
+
+class RequestUserTestCases(AppTestCase):
+
+    def assertOneResolution(self, url):
+        from project.sessions import session_cache
+
+        before = session_cache.resolutions
+        r = self.client.get(url)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(session_cache.resolutions - before, 1, url)
+        return r
+
+    def testOneResolutionPerRequest(self):
+        restaurant_id = self.createRestaurant()
+        self.createUser()
+        self.login()
+
+        for url in ["/restaurant/", f"/restaurant/{restaurant_id}/menu/", "/account/", "/login/"]:
+            r = self.assertOneResolution(url)
+            self.assertIn("tester", r.text)
+
+    def testOneResolutionPerAnonymousRequest(self):
+        restaurant_id = self.createRestaurant()
+
+        for url in ["/restaurant/", f"/restaurant/{restaurant_id}/menu/", "/signup/"]:
+            r = self.assertOneResolution(url)
+            self.assertIn("Log In", r.text)
+
+
+class MenuQueryTestCases(AppTestCase):
+
+    def addComments(self, restaurant_id, count):
+        from werkzeug import security
+        from project import db
+        from project.models import Comment, User
+
+        with self.app.app_context():
+            for i in range(count):
+                user = User(name=f"commenter{restaurant_id}.{i}", email=f"commenter{restaurant_id}.{i}@example.com",
+                            permission=0,
+                            password=security.generate_password_hash("password", method="pbkdf2:sha256:1"))
+                db.session.add(user)
+                db.session.flush()
+                db.session.add(Comment(title=f"Comment {i}", description="Tasty", restaurantid=restaurant_id,
+                                       userid=user.id, username=True))
+            db.session.commit()
+
+    def countMenuQueries(self, restaurant_id):
+        selects = self.countStatements("SELECT")
+        r = self.client.get(f"/restaurant/{restaurant_id}/menu/")
+        self.assertEqual(r.status_code, 200)
+        return len(selects)
+
+    def testMenuQueriesDoNotScaleWithComments(self):
+        from project import db
+        from project.models import MenuItem
+
+        small = self.createRestaurant("Small")
+        large = self.createRestaurant("Large")
+        with self.app.app_context():
+            for restaurant_id in (small, large):
+                db.session.add(MenuItem(name="Soup", course="Entree", price="$1.00", restaurant_id=restaurant_id))
+            db.session.commit()
+        self.addComments(small, 1)
+        self.addComments(large, 20)
+
+        self.createUser()
+        self.login()
+        self.client.get("/restaurant/")  # warm the session cache
+
+        small_queries = self.countMenuQueries(small)
+        large_queries = self.countMenuQueries(large)
+
+        self.assertEqual(small_queries, large_queries)
+        self.assertLessEqual(large_queries, 4)
+
+    def testMenuShowsCommentAuthors(self):
+        restaurant_id = self.createRestaurant()
+        self.addComments(restaurant_id, 3)
+
+        r = self.client.get(f"/restaurant/{restaurant_id}/menu/")
+        for i in range(3):
+            self.assertIn(f"commenter{restaurant_id}.{i}", r.text)
+
+
+class MenuGroupingTestCases(AppTestCase):
+
+    def addItem(self, restaurant_id, name, course):
+        from project import db
+        from project.models import MenuItem
+
+        with self.app.app_context():
+            db.session.add(MenuItem(name=name, course=course, price="$1.00", restaurant_id=restaurant_id))
+            db.session.commit()
+
+    def testGroupMenu(self):
+        from project.main import group_menu
+        from project.models import MenuItem
+
+        items = [MenuItem(name="Cake", course="Dessert"), MenuItem(name="Soup", course="Appetizer"),
+                 MenuItem(name="Mystery", course=""), MenuItem(name="Tea", course="Beverage"),
+                 MenuItem(name="Pie", course="Dessert")]
+        menu = group_menu(items)
+
+        self.assertEqual(list(menu), ["Appetizer", "Dessert", "Beverage", "Other"])
+        self.assertEqual([i["name"] for i in menu["Dessert"]], ["Cake", "Pie"])
+        self.assertEqual([i["name"] for i in menu["Other"]], ["Mystery"])
+
+    def testItemsWithoutKnownCourseAreShown(self):
+        restaurant_id = self.createRestaurant()
+        self.addItem(restaurant_id, "Ramen", "")
+
+        r = self.client.get(f"/restaurant/{restaurant_id}/menu/")
+        self.assertIn("Ramen", r.text)
+        self.assertIn("Other", r.text)
+
+    def testNewItemInvalidatesGroupedMenu(self):
+        from project import db
+        from project.models import User
+
+        restaurant_id = self.createRestaurant()
+        user_id = self.createUser()
+        with self.app.app_context():
+            db.session.get(User, user_id).restaurant = restaurant_id
+            db.session.commit()
+        self.login()
+
+        self.assertNotIn("Gelato", self.client.get(f"/restaurant/{restaurant_id}/menu/").text)
+
+        data = {"name": "Gelato", "description": "Pistachio", "price": "4.50", "course": "Dessert"}
+        self.client.post(f"/restaurant/{restaurant_id}/menu/new/", data=data)
+
+        self.assertIn("Gelato", self.client.get(f"/restaurant/{restaurant_id}/menu/").text)
+
+
+class PageCacheTestCases(AppTestCase):
+
+    def testAnonymousPagesAreCached(self):
+        from project.main import page_cache
+
+        restaurant_id = self.createRestaurant("Cached Cafe")
+        self.client.get(f"/restaurant/{restaurant_id}/menu/")
+
+        selects = self.countStatements("SELECT")
+        hits = page_cache.hits
+        r = self.client.get(f"/restaurant/{restaurant_id}/menu/")
+
+        self.assertIn("Cached Cafe", r.text)
+        self.assertEqual(page_cache.hits, hits + 1)
+        self.assertEqual(selects, [])
+
+    def testUsersAndAnonymousGetSeparatePages(self):
+        self.createUser()
+        self.assertIn("Log In", self.client.get("/restaurant/").text)
+
+        self.login()
+        r = self.client.get("/restaurant/")
+        self.assertIn("tester", r.text)
+        self.assertNotIn("Log In", r.text)
+
+    def testNewCommentInvalidatesMenu(self):
+        restaurant_id = self.createRestaurant()
+        other_id = self.createRestaurant("Other Restaurant")
+        self.createUser()
+        self.login()
+
+        self.client.get(f"/restaurant/{restaurant_id}/menu/")
+        self.client.get(f"/restaurant/{other_id}/menu/")
+        self.client.post(f"/restaurant/{restaurant_id}/comment/new/", data={"title": "Great", "description": "Yum"})
+        self.client.get("/login/")  # consume the flashed message
+
+        from project.main import page_cache
+        misses = page_cache.misses
+        self.assertIn("Great", self.client.get(f"/restaurant/{restaurant_id}/menu/").text)
+        self.assertEqual(page_cache.misses, misses + 1)
+
+        hits = page_cache.hits
+        self.client.get(f"/restaurant/{other_id}/menu/")
+        self.assertEqual(page_cache.hits, hits + 1)
+
+    def testFlashedPagesAreNotCached(self):
+        restaurant_id = self.createRestaurant()
+        self.createUser()
+        self.login()
+
+        self.client.post(f"/restaurant/{restaurant_id}/comment/new/", data={"title": "Great", "description": "Yum"})
+        self.assertIn("Successfully Created", self.client.get(f"/restaurant/{restaurant_id}/menu/").text)
+        self.assertNotIn("Successfully Created", self.client.get(f"/restaurant/{restaurant_id}/menu/").text)
+
+
+class JSONConditionalTestCases(AppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        from project import db
+        from project.models import MenuItem, User
+
+        self.restaurant_id = self.createRestaurant()
+        user_id = self.createUser()
+        with self.app.app_context():
+            item = MenuItem(name="Soup", course="Entree", price="$1.00", restaurant_id=self.restaurant_id)
+            db.session.add(item)
+            db.session.get(User, user_id).restaurant = self.restaurant_id
+            db.session.commit()
+            self.item_id = item.id
+
+    def assertRevalidates(self, url):
+        r = self.client.get(url)
+        self.assertEqual(r.status_code, 200)
+        etag = r.headers["ETag"]
+
+        selects = self.countStatements("SELECT")
+        r = self.client.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(r.status_code, 304)
+        self.assertEqual(r.headers["ETag"], etag)
+        self.assertEqual(selects, [])
+
+        return etag
+
+    def testUnchangedResourcesReturnNotModified(self):
+        self.assertRevalidates("/restaurant/JSON")
+        self.assertRevalidates(f"/restaurant/{self.restaurant_id}/menu/JSON")
+        self.assertRevalidates(f"/restaurant/{self.restaurant_id}/menu/{self.item_id}/JSON")
+
+    def testEditingAnItemChangesTags(self):
+        menu_url = f"/restaurant/{self.restaurant_id}/menu/JSON"
+        item_url = f"/restaurant/{self.restaurant_id}/menu/{self.item_id}/JSON"
+        restaurants_etag = self.assertRevalidates("/restaurant/JSON")
+        menu_etag = self.assertRevalidates(menu_url)
+        item_etag = self.assertRevalidates(item_url)
+
+        self.login()
+        data = {"name": "Stew", "description": "", "price": "", "course": ""}
+        self.client.post(f"/restaurant/{self.restaurant_id}/menu/{self.item_id}/edit", data=data)
+
+        r = self.client.get(menu_url, headers={"If-None-Match": menu_etag})
+        self.assertEqual(r.status_code, 200)
+        self.assertIn("Stew", r.text)
+        r = self.client.get(item_url, headers={"If-None-Match": item_etag})
+        self.assertEqual(r.status_code, 200)
+        # The restaurant's updated_at changes with its items
+        r = self.client.get("/restaurant/JSON", headers={"If-None-Match": restaurants_etag})
+        self.assertEqual(r.status_code, 200)
+
+    def testNewItemChangesTagOfItsId(self):
+        from project import db
+        from project.models import MenuItem
+
+        with self.app.app_context():
+            next_id = db.session.query(db.func.max(MenuItem.id)).scalar() + 1
+        item_url = f"/restaurant/{self.restaurant_id}/menu/{next_id}/JSON"
+        etag = self.assertRevalidates(item_url)
+
+        self.login()
+        data = {"name": "Stew", "description": "", "price": "$2.00", "course": ""}
+        self.client.post(f"/restaurant/{self.restaurant_id}/menu/new/", data=data)
+
+        r = self.client.get(item_url, headers={"If-None-Match": etag})
+        self.assertEqual(r.status_code, 200)
+        self.assertIn("Stew", r.text)
+        self.assertNotEqual(r.headers["ETag"], etag)
+
+    def testStatementsAreCompiledOnce(self):
+        from project import db
+
+        other_id = self.createRestaurant("Other Restaurant")
+        with self.app.app_context():
+            compiled_cache = db.engine._compiled_cache
+
+        def fetch_all(restaurant_id):
+            self.client.get(f"/restaurant/{restaurant_id}/menu/JSON").close()
+            self.client.get(f"/restaurant/{restaurant_id}/menu/{self.item_id}/JSON").close()
+
+        fetch_all(self.restaurant_id)
+        compiled = len(compiled_cache)
+
+        # Other parameters reuse the compiled statements, and they are sent as bound parameters
+        selects = self.countStatements("SELECT")
+        fetch_all(other_id)
+        self.assertEqual(len(compiled_cache), compiled)
+        self.assertTrue(selects)
+        self.assertTrue(all(str(other_id) not in statement for statement in selects))
+
+
+class PaginationTestCases(AppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        from project import db
+        from project.models import MenuItem
+
+        # Two restaurants share a name so the id breaks the tie
+        self.names = ["Cafe", "Bistro", "Diner", "Bistro", "Alehouse"]
+        self.restaurant_ids = [self.createRestaurant(name) for name in self.names]
+        with self.app.app_context():
+            for i in range(5):
+                db.session.add(MenuItem(name=f"Item {i}", restaurant_id=self.restaurant_ids[0]))
+            db.session.commit()
+
+    def walkJSON(self, url):
+        rows = []
+        while url is not None:
+            r = self.client.get(url)
+            self.assertEqual(r.status_code, 200)
+            page = r.get_json()
+            self.assertLessEqual(len(page), 2)
+            rows += page
+            link = r.headers.get("Link")
+            url = None if link is None else link[1:link.index(">")]
+        return rows
+
+    def testPageEndsAtItsCursor(self):
+        import sqlite3
+        from unittest import mock
+        from urllib.parse import parse_qs, urlsplit
+        from sqlalchemy.engine import make_url
+        from project import json as json_api
+        from project.pagination import parse_cursor
+
+        probe_next_cursor = json_api.probe_next_cursor
+        database = make_url(self.app.config["SQLALCHEMY_DATABASE_URI"]).database
+
+        def probe_then_insert(*args):
+            cursor = probe_next_cursor(*args)
+            # Another thread adds a restaurant sorting first before the page is read
+            with sqlite3.connect(database) as connection:
+                connection.execute("INSERT INTO restaurant (name) VALUES ('Aardvark Inn')")
+            return cursor
+
+        with mock.patch.object(json_api, "probe_next_cursor", probe_then_insert):
+            r = self.client.get("/restaurant/JSON?limit=2")
+
+        link = r.headers["Link"]
+        query = parse_qs(urlsplit(link[1:link.index(">")]).query)
+        cursor = parse_cursor(query["cursor"][0], str, int)
+        last = r.get_json()[-1]
+        self.assertEqual(cursor, [last["name"], last["id"]])
+
+    def testRestaurantsJSONPages(self):
+        rows = self.walkJSON("/restaurant/JSON?limit=2")
+        self.assertEqual([r["name"] for r in rows], sorted(self.names))
+        self.assertEqual(len({r["id"] for r in rows}), 5)
+
+    def testMenuJSONPages(self):
+        rows = self.walkJSON(f"/restaurant/{self.restaurant_ids[0]}/menu/JSON?limit=2")
+        self.assertEqual([r["name"] for r in rows], [f"Item {i}" for i in range(5)])
+
+    def testPageSizeIsCapped(self):
+        self.app.config["MAX_PAGE_SIZE"] = 3
+        self.assertEqual(len(self.client.get("/restaurant/JSON?limit=1000").get_json()), 3)
+
+    def testRestaurantListPages(self):
+        r = self.client.get("/restaurant/?limit=3")
+        self.assertIn("Next Page", r.text)
+        self.assertIn("Alehouse", r.text)
+        self.assertNotIn("Diner", r.text)
+
+    def testMalformedCursor(self):
+        self.assertEqual(self.client.get("/restaurant/?cursor=notacursor").status_code, 400)
+        self.assertEqual(self.client.get("/restaurant/JSON?cursor=WzFd").status_code, 400)
+
+    def testCursorOutOfRange(self):
+        from project.pagination import encode_cursor
+
+        cursor = encode_cursor("a", 10 ** 30)
+        self.assertEqual(self.client.get(f"/restaurant/?cursor={cursor}").status_code, 400)
+        self.assertEqual(self.client.get(f"/restaurant/JSON?cursor={cursor}").status_code, 400)
+        menu = f"/restaurant/{self.restaurant_ids[0]}/menu/JSON"
+        self.assertEqual(self.client.get(f"{menu}?cursor={encode_cursor(10 ** 30)}").status_code, 400)
+        self.assertEqual(self.client.get(f"{menu}?cursor={encode_cursor(-2 ** 63)}").status_code, 200)
+
+    def testListsAreStreamed(self):
+        import json
+
+        r = self.client.get(f"/restaurant/{self.restaurant_ids[0]}/menu/JSON")
+        self.assertTrue(r.is_streamed)
+        self.assertEqual(r.text, json.dumps(r.get_json()))
+
+        r = self.client.get("/restaurant/JSON")
+        self.assertTrue(r.is_streamed)
+        self.assertEqual(r.text, json.dumps(r.get_json()))
+
+
+class CounterTestCases(AppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        from project import db
+        from project.models import User
+
+        self.restaurant_id = self.createRestaurant("Counted")
+        user_id = self.createUser()
+        with self.app.app_context():
+            db.session.get(User, user_id).restaurant = self.restaurant_id
+            db.session.commit()
+        self.login()
+
+    def counts(self):
+        from project import db
+        from project.models import Restaurant
+
+        with self.app.app_context():
+            restaurant = db.session.get(Restaurant, self.restaurant_id)
+            return restaurant.item_count, restaurant.comment_count
+
+    def makeItem(self):
+        from project.models import MenuItem
+
+        return MenuItem(name="Untracked", restaurant_id=self.restaurant_id)
+
+    def testViewsMaintainCounters(self):
+        from project import db
+        from project.models import MenuItem
+
+        data = {"name": "Gelato", "description": "Pistachio", "price": "4.50", "course": "Dessert"}
+        self.client.post(f"/restaurant/{self.restaurant_id}/menu/new/", data=data)
+        self.client.post(f"/restaurant/{self.restaurant_id}/menu/new/", data=dict(data, name="Sorbet"))
+        self.client.post(f"/restaurant/{self.restaurant_id}/comment/new/", data={"title": "Yum", "description": "!"})
+        self.assertEqual(self.counts(), (2, 1))
+
+        with self.app.app_context():
+            item_id = db.session.query(MenuItem.id).filter_by(name="Gelato").scalar()
+        self.client.post(f"/restaurant/{self.restaurant_id}/menu/{item_id}/delete")
+        self.assertEqual(self.counts(), (1, 1))
+
+    def testEditingAnItemUpdatesRestaurant(self):
+        from project import db
+        from project.models import MenuItem, Restaurant
+
+        with self.app.app_context():
+            item = self.makeItem()
+            db.session.add(item)
+            db.session.execute(db.update(Restaurant).values(updated_at=0))
+            db.session.commit()
+            item_id = item.id
+
+        data = {"name": "Tracked", "description": "", "price": "", "course": ""}
+        self.client.post(f"/restaurant/{self.restaurant_id}/menu/{item_id}/edit", data=data)
+        with self.app.app_context():
+            self.assertGreater(db.session.get(Restaurant, self.restaurant_id).updated_at, 0)
+            self.assertEqual(db.session.get(MenuItem, item_id).name, "Tracked")
+
+    def testListingShowsCountersWithoutCounting(self):
+        self.client.post(f"/restaurant/{self.restaurant_id}/comment/new/", data={"title": "Yum", "description": "!"})
+
+        selects = self.countStatements("SELECT")
+        r = self.client.get("/restaurant/")
+        self.assertIn("0 menu items", r.text)
+        self.assertIn("1 comment\n", r.text)
+        self.assertFalse(any("count(" in statement.lower() for statement in selects))
+
+    def testRebuildCorrectsDrift(self):
+        from sqlalchemy import text
+        from project import db
+
+        with self.app.app_context():
+            db.session.add_all([self.makeItem(), self.makeItem()])
+            db.session.execute(text("UPDATE restaurant SET comment_count = 5"))
+            db.session.commit()
+
+        result = self.app.test_cli_runner().invoke(args=["rebuild-counters"])
+        self.assertIn("Corrected the counters of 1 restaurants.", result.output)
+        self.assertEqual(self.counts(), (2, 0))
+
+    def testMigrationAddsCounters(self):
+        from sqlalchemy import text
+        from project import db
+        from initialise_db import migrate_db
+
+        with self.app.app_context():
+            db.session.add(self.makeItem())
+            for column in ["item_count", "comment_count", "updated_at"]:
+                db.session.execute(text(f"ALTER TABLE restaurant DROP COLUMN {column}"))
+            db.session.commit()
+
+            migrate_db()
+            migrate_db()
+        self.assertEqual(self.counts(), (1, 0))
+
+
+class RestaurantDeletionTestCases(AppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        from project import db
+        from project.models import Comment, MenuItem, User
+
+        self.restaurant_id = self.createRestaurant("Doomed")
+        self.other_id = self.createRestaurant("Survivor")
+        user_id = self.createUser()
+        with self.app.app_context():
+            db.session.get(User, user_id).restaurant = self.restaurant_id
+            for restaurant_id in (self.restaurant_id, self.other_id):
+                for i in range(3):
+                    db.session.add(MenuItem(name=f"Item {i}", restaurant_id=restaurant_id))
+                    db.session.add(Comment(title=f"Comment {i}", description="", restaurantid=restaurant_id,
+                                           userid=user_id))
+            db.session.commit()
+
+    def remaining(self):
+        from project import db
+        from project.models import Comment, MenuItem
+
+        with self.app.app_context():
+            return {restaurant_id for restaurant_id, in db.session.query(MenuItem.restaurant_id).union(
+                db.session.query(Comment.restaurantid))}
+
+    def testDeletionRemovesItemsAndComments(self):
+        self.login()
+        item_url = f"/restaurant/{self.restaurant_id}/menu/1/JSON"
+        etag = self.client.get(item_url).headers["ETag"]
+
+        deletes = self.countStatements("DELETE")
+        self.client.post(f"/restaurant/{self.restaurant_id}/delete/")
+
+        self.assertEqual(len(deletes), 3)
+        self.assertEqual(self.remaining(), {self.other_id})
+        r = self.client.get(item_url, headers={"If-None-Match": etag})
+        self.assertEqual(r.get_json(), [])
+        self.assertEqual(self.client.get("/search/JSON?q=Comment").get_json()[0]["restaurant_id"], self.other_id)
+
+    def testCompactPurgesOrphans(self):
+        from sqlalchemy import text
+        from project import db
+        from initialise_db import compact_db
+
+        with self.app.app_context():
+            db.session.execute(text("DELETE FROM restaurant WHERE id = :id"), {"id": self.restaurant_id})
+            db.session.commit()
+        self.assertEqual(self.remaining(), {self.restaurant_id, self.other_id})
+
+        with self.app.app_context():
+            compact_db()
+        self.assertEqual(self.remaining(), {self.other_id})
+
+
+class PriceTestCases(AppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        from project import db
+        from project.models import MenuItem
+
+        self.restaurant_id = self.createRestaurant()
+        items = [("Soup", "$4.50", "Appetizer"), ("Steak", "$21", "Entree"), ("Pasta", "12.99", "Entree"),
+                 ("Tea", "$.99", "Beverage"), ("Special", "", "Entree"), ("Burger", "$9.99", "Entree")]
+        with self.app.app_context():
+            for name, price, course in items:
+                db.session.add(MenuItem(name=name, price=price, course=course, restaurant_id=self.restaurant_id))
+            db.session.commit()
+
+    def menuJSON(self, query):
+        r = self.client.get(f"/restaurant/{self.restaurant_id}/menu/JSON?{query}")
+        self.assertEqual(r.status_code, 200)
+        return r.get_json()
+
+    def testParsePrice(self):
+        from project.models import parse_price, format_price
+
+        self.assertEqual(parse_price("$2.99"), 299)
+        self.assertEqual(parse_price("$.99"), 99)
+        self.assertEqual(parse_price("25"), 2500)
+        self.assertIsNone(parse_price(" "))
+        self.assertEqual(parse_price("92233720368547758.07"), 2 ** 63 - 1)
+        for invalid in ["abc", "-1", "1.999", "nan", "1e30", "99999999999999999999", "92233720368547758.08"]:
+            self.assertRaises(ValueError, parse_price, invalid)
+        self.assertEqual(format_price(99), "$0.99")
+        self.assertEqual(format_price(None), "")
+
+    def testJSONKeepsFormattedPrice(self):
+        items = {item["name"]: item for item in self.menuJSON("")}
+        self.assertEqual(items["Steak"]["price"], "$21.00")
+        self.assertEqual(items["Steak"]["price_cents"], 2100)
+        self.assertEqual(items["Special"]["price"], "")
+        self.assertIsNone(items["Special"]["price_cents"])
+
+    def testFilterAndSortJSON(self):
+        rows = self.menuJSON("course=Entree&min_price=10&sort=price")
+        self.assertEqual([item["name"] for item in rows], ["Pasta", "Steak"])
+
+        url = f"/restaurant/{self.restaurant_id}/menu/JSON?sort=price&limit=2"
+        names = []
+        while url is not None:
+            r = self.client.get(url)
+            names += [item["name"] for item in r.get_json()]
+            link = r.headers.get("Link")
+            url = None if link is None else link[1:link.index(">")]
+        self.assertEqual(names, ["Tea", "Soup", "Burger", "Pasta", "Steak"])
+
+    def testInvalidFiltersAreRejected(self):
+        for query in ["min_price=cheap", "sort=name", "min_price=1e30", "max_price=99999999999999999999"]:
+            self.assertEqual(self.client.get(f"/restaurant/{self.restaurant_id}/menu/JSON?{query}").status_code, 400)
+            self.assertEqual(self.client.get(f"/restaurant/{self.restaurant_id}/menu/?{query}").status_code, 400)
+
+    def testFilteredMenuPage(self):
+        r = self.client.get(f"/restaurant/{self.restaurant_id}/menu/?course=Entree&max_price=10")
+        self.assertIn("Burger", r.text)
+        self.assertNotIn("Steak", r.text)
+        self.assertNotIn("Soup", r.text)
+        self.assertIn("Steak", self.client.get(f"/restaurant/{self.restaurant_id}/menu/").text)
+
+    def testInvalidPriceIsNotSaved(self):
+        from project import db
+        from project.models import MenuItem, User
+
+        user_id = self.createUser()
+        with self.app.app_context():
+            db.session.get(User, user_id).restaurant = self.restaurant_id
+            item_id = db.session.query(MenuItem.id).filter_by(name="Soup").scalar()
+            db.session.commit()
+        self.login()
+
+        data = {"name": "Soup", "description": "", "price": "free", "course": ""}
+        self.client.post(f"/restaurant/{self.restaurant_id}/menu/{item_id}/edit", data=data)
+        data["price"] = "$5"
+        self.client.post(f"/restaurant/{self.restaurant_id}/menu/{item_id}/edit", data=data)
+
+        with self.app.app_context():
+            self.assertEqual(db.session.get(MenuItem, item_id).price_cents, 500)
+
+    def testFiltersUseIndex(self):
+        from sqlalchemy import text
+        from project import db
+        from project.json import menu_page_statements
+
+        page, _ = menu_page_statements(("course", "max_price", "min_price"), True)
+        page = page.params(restaurant_id=1, course="Entree", min_price=0, max_price=1000, after_price=-1,
+                           after=0).limit(10)
+        with self.app.app_context():
+            statement = str(page.compile(db.engine, compile_kwargs={"literal_binds": True}))
+            plan = " ".join(row[-1] for row in db.session.execute(text("EXPLAIN QUERY PLAN " + statement)))
+        self.assertIn("INDEX ix_menu_item_restaurant_id_course_price", plan)
+        self.assertNotIn("TEMP B-TREE", plan)
+
+    def testMigrationConvertsPrices(self):
+        from sqlalchemy import inspect, text
+        from project import db
+        from initialise_db import migrate_db
+
+        with self.app.app_context():
+            db.session.execute(text("DROP INDEX ix_menu_item_restaurant_id_course_price"))
+            db.session.execute(text("ALTER TABLE menu_item DROP COLUMN price_cents"))
+            db.session.execute(text("ALTER TABLE menu_item ADD COLUMN price VARCHAR(8)"))
+            db.session.execute(text("UPDATE menu_item SET price = CASE name WHEN 'Tea' THEN '$.99' "
+                                    "WHEN 'Steak' THEN 'market' ELSE '$3.50' END"))
+            db.session.commit()
+
+            migrate_db()
+            migrate_db()
+
+            columns = {column["name"] for column in inspect(db.engine).get_columns("menu_item")}
+            self.assertNotIn("price", columns)
+            prices = dict(db.session.execute(text("SELECT name, price_cents FROM menu_item")).all())
+        self.assertEqual(prices["Tea"], 99)
+        self.assertEqual(prices["Soup"], 350)
+        self.assertIsNone(prices["Steak"])
+
+
+@unittest.skipUnless(importlib.util.find_spec("aiosqlite"), "the asynchronous JSON API requires aiosqlite")
+class AsyncJSONTestCases(AppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        from project import db
+        from project.asgi import create_asgi_app
+        from project.models import MenuItem
+
+        self.restaurant_ids = [self.createRestaurant(name) for name in ["Cafe", "Bistro", "Diner", "Bistro"]]
+        with self.app.app_context():
+            for i in range(5):
+                db.session.add(MenuItem(name=f"Item {i}", price="$1.00", restaurant_id=self.restaurant_ids[0]))
+            db.session.commit()
+
+        self.asgi_app = create_asgi_app({"SQLALCHEMY_DATABASE_URI": self.app.config["SQLALCHEMY_DATABASE_URI"]})
+
+    def tearDown(self):
+        asyncio.run(self.asgi_app.engine.dispose())
+        super().tearDown()
+
+    def get(self, url, method="GET"):
+        """Returns the status, headers and body of a GET, or another method's, request to the ASGI app"""
+        path, _, query = url.partition("?")
+        scope = {"type": "http", "method": method, "path": path, "query_string": query.encode(), "headers": []}
+        messages = []
+
+        async def receive():
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        async def send(message):
+            messages.append(message)
+
+        asyncio.run(self.asgi_app(scope, receive, send))
+
+        headers = {name.decode(): value.decode() for name, value in messages[0]["headers"]}
+        body = b"".join(message.get("body", b"") for message in messages[1:]).decode()
+        return messages[0]["status"], headers, body
+
+    def testOnlyReads(self):
+        url = f"/restaurant/{self.restaurant_ids[0]}/menu/JSON"
+        for method in ["POST", "PUT", "DELETE"]:
+            status, headers, body = self.get(url, method)
+            self.assertEqual(status, 405)
+            self.assertEqual(set(headers["allow"].split(", ")), {"GET", "HEAD"})
+        self.assertEqual(self.get(url, "HEAD")[0], 200)
+
+    def testResponsesMatchWSGI(self):
+        urls = [
+            "/restaurant/JSON",
+            "/restaurant/JSON?limit=2",
+            f"/restaurant/{self.restaurant_ids[0]}/menu/JSON?limit=2",
+            f"/restaurant/{self.restaurant_ids[1]}/menu/JSON",
+            f"/restaurant/{self.restaurant_ids[0]}/menu/1/JSON",
+            f"/restaurant/{self.restaurant_ids[0]}/menu/JSON?limit=2&sort=price&max_price=5",
+        ]
+
+        while urls:
+            url = urls.pop()
+            status, headers, body = self.get(url)
+            expected = self.client.get(url)
+
+            self.assertEqual(status, 200)
+            self.assertEqual(body, expected.text)
+            self.assertEqual(headers.get("link"), expected.headers.get("Link"))
+            if "link" in headers:
+                urls.append(headers["link"][1:headers["link"].index(">")])
+
+    def testErrors(self):
+        self.assertEqual(self.get("/restaurant/")[0], 404)
+        self.assertEqual(self.get("/restaurant/JSON?cursor=notacursor")[0], 400)
+        self.assertEqual(self.get(f"/restaurant/{self.restaurant_ids[0]}/menu/JSON?min_price=cheap")[0], 400)
+
+
+class SearchTestCases(AppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        from project import db
+        from project.models import MenuItem, Comment
+
+        self.restaurant_id = self.createRestaurant("Noodle House")
+        self.other_id = self.createRestaurant("Burger Barn")
+        user_id = self.createUser()
+        with self.app.app_context():
+            soup = MenuItem(name="Beef Noodle Soup", description="slow cooked broth", course="Entree",
+                            restaurant_id=self.restaurant_id)
+            burger = MenuItem(name="Cheeseburger", description="comes with noodles on request", course="Entree",
+                              restaurant_id=self.other_id)
+            comment = Comment(title="Great broth", description="The best soup in town",
+                              restaurantid=self.restaurant_id, userid=user_id)
+            db.session.add_all([soup, burger, comment])
+            db.session.commit()
+            self.soup_id = soup.id
+
+    def search(self, terms):
+        r = self.client.get("/search/JSON", query_string={"q": terms})
+        self.assertEqual(r.status_code, 200)
+        return [(result["type"], result["title"]) for result in r.get_json()]
+
+    def testRankedResults(self):
+        self.assertEqual(self.search("noodle"), [
+            ("restaurant", "Noodle House"),
+            ("menu_item", "Beef Noodle Soup"),
+            ("menu_item", "Cheeseburger"),
+        ])
+        self.assertEqual(self.search("broth"), [("comment", "Great broth"), ("menu_item", "Beef Noodle Soup")])
+        # The last word matches as a prefix
+        self.assertEqual(self.search("burg"), [("restaurant", "Burger Barn")])
+
+    def testEveryMatchIsRanked(self):
+        from project import db
+        from project.models import Comment
+
+        # Many weak matches written before the best one
+        with self.app.app_context():
+            db.session.add_all(Comment(title="Visit", description="a long review mentioning dumplings once",
+                                       restaurantid=self.other_id, userid=None) for _ in range(1200))
+            db.session.commit()
+        self.createRestaurant("Dumplings")
+
+        r = self.client.get("/search/JSON", query_string={"q": "dumplings", "limit": 1})
+        self.assertEqual([(result["type"], result["title"]) for result in r.get_json()], [("restaurant", "Dumplings")])
+
+    def testIndexFollowsChanges(self):
+        from project import db
+        from project.models import MenuItem
+
+        with self.app.app_context():
+            db.session.get(MenuItem, self.soup_id).name = "Pho"
+            db.session.commit()
+        self.assertIn(("menu_item", "Pho"), self.search("pho"))
+        self.assertNotIn(("menu_item", "Beef Noodle Soup"), self.search("noodle"))
+
+        with self.app.app_context():
+            db.session.query(MenuItem).filter_by(id=self.soup_id).delete()
+            db.session.commit()
+        self.assertEqual(self.search("pho"), [])
+
+    def testExistingRowsAreIndexed(self):
+        from project import db
+
+        with self.app.app_context():
+            db.session.execute(db.text("DROP TABLE search_index"))
+            db.session.commit()
+            db.create_all()
+        self.assertEqual(len(self.search("noodle")), 3)
+
+    def testQuerySyntaxIsEscaped(self):
+        for terms in ['"', 'noodle AND (', 'NEAR(', '*', '']:
+            self.search(terms)
+
+    def testSearchPage(self):
+        r = self.client.get("/search/", query_string={"q": "soup"})
+        self.assertIn("Beef Noodle Soup", r.text)
+        self.assertIn(f"/restaurant/{self.restaurant_id}/menu/", r.text)
+        self.assertIn("No restaurants", self.client.get("/search/?q=sushi").text)
+
+
+class IndexTestCases(AppTestCase):
+
+    def queryPlan(self, statement, **params):
+        from sqlalchemy import text
+        from project import db
+
+        with self.app.app_context():
+            rows = db.session.execute(text("EXPLAIN QUERY PLAN " + statement), params).all()
+        return " ".join(row[-1] for row in rows)
+
+    def assertUsesIndex(self, statement, index, **params):
+        plan = self.queryPlan(statement, **params)
+        self.assertIn(f"INDEX {index}", plan, statement)
+        self.assertNotIn("SCAN", plan, statement)
+
+    def testHotLookupsUseIndexes(self):
+        self.assertUsesIndex("select * from user_token where token = :token", "ix_user_token_token", token="x")
+        self.assertUsesIndex("select * from user where email = :email", "ix_user_email", email="x")
+        self.assertUsesIndex("select * from user where name = :name", "ix_user_name", name="x")
+        self.assertUsesIndex("select * from menu_item where restaurant_id = :id", "ix_menu_item_restaurant_id_id", id=1)
+        self.assertUsesIndex("select * from comment where restaurantid = :id", "ix_comment_restaurantid", id=1)
+
+    def testMigrationAddsMissingIndexes(self):
+        from sqlalchemy import inspect, text
+        from project import db
+        from initialise_db import migrate_db
+
+        with self.app.app_context():
+            for index in ["ix_user_token_token", "ix_user_email", "ix_comment_restaurantid"]:
+                db.session.execute(text(f"DROP INDEX {index}"))
+            db.session.commit()
+
+            migrate_db()
+            migrate_db()
+
+            indexes = {index["name"] for index in inspect(db.engine).get_indexes("user")}
+            self.assertIn("ix_user_email", indexes)
+        self.assertUsesIndex("select * from user_token where token = :token", "ix_user_token_token", token="x")
+
+
+class DatabaseProfileTestCases(AppTestCase):
+
+    def pragma(self, name):
+        from sqlalchemy import text
+        from project import db
+
+        with self.app.app_context():
+            return db.session.execute(text(f"PRAGMA {name}")).scalar()
+
+    def testSQLitePragmas(self):
+        self.assertEqual(self.pragma("journal_mode"), "wal")
+        self.assertEqual(self.pragma("synchronous"), 1)  # NORMAL
+        self.assertEqual(self.pragma("busy_timeout"), 5000)
+        self.assertEqual(self.pragma("cache_size"), -65536)
+
+    def testPoolOptions(self):
+        from project import db
+
+        with self.app.app_context():
+            self.assertEqual(db.engine.pool.size(), self.app.config["DATABASE_POOL_SIZE"])
+
+    def testDatabaseURIFromEnvironment(self):
+        import os
+        from unittest import mock
+        from project import create_app, db
+
+        uri = "sqlite:///" + os.path.join(self.tmpdir.name, "environment.db")
+        with mock.patch.dict(os.environ, {"FLASK_SQLALCHEMY_DATABASE_URI": uri, "FLASK_SECRET_KEY": "environment"}):
+            app = create_app({"SESSION_FLUSH_THREAD": False})
+
+        self.assertEqual(app.config["SQLALCHEMY_DATABASE_URI"], uri)
+        with app.app_context():
+            db.create_all()
+            db.engine.dispose()
+        self.assertTrue(os.path.exists(os.path.join(self.tmpdir.name, "environment.db")))
+
+
+class SeedingTestCases(AppTestCase):
+
+    def testPopulateSampleData(self):
+        from project import db
+        from project.models import Restaurant, MenuItem
+        from initialise_db import populate_db, SAMPLE_MENUS
+
+        with self.app.app_context():
+            populate_db()
+            self.assertEqual(db.session.query(Restaurant).count(), len(SAMPLE_MENUS))
+            self.assertEqual(db.session.query(MenuItem).count(), sum(len(items) for _, items in SAMPLE_MENUS))
+
+    def testGenerateSyntheticData(self):
+        from sqlalchemy import func
+        from project import db
+        from project.models import Restaurant, MenuItem, Comment, User
+        from initialise_db import generate_synthetic_data
+
+        self.createRestaurant()
+        with self.app.app_context():
+            generate_synthetic_data(restaurants=30, items=7, comments=3, users=4, batch_size=16)
+
+            self.assertEqual(db.session.query(Restaurant).count(), 31)
+            self.assertEqual(db.session.query(MenuItem).count(), 30 * 7)
+            self.assertEqual(db.session.query(Comment).count(), 30 * 3)
+            self.assertEqual(db.session.query(User).count(), 4)
+            self.assertEqual(db.session.query(func.count(func.distinct(Comment.userid))).scalar(), 4)
+
+            from project import counters
+            self.assertEqual(counters.rebuild(), 0)
+
+        # Generated users can log in
+        self.login("user1@example.com")
+        self.assertIn("user1", self.client.get("/account/").text)
+
+
+class PasswordHashingTestCases(AppTestCase):
+
+    def appConfig(self):
+        return dict(super().appConfig(), PASSWORD_HASH_WORKERS=1, PASSWORD_HASH_QUEUE=2)
+
+    def testSignupAndLoginThroughPool(self):
+        from werkzeug import security
+        from project import db
+        from project.models import User
+
+        self.client.post("/signup/", data={"name": "pooled", "email": "pooled@example.com",
+                                           "password": "secret", "password_verification": "secret"})
+        with self.app.app_context():
+            user = db.session.query(User).filter_by(email="pooled@example.com").one()
+            self.assertTrue(security.check_password_hash(user.password, "secret"))
+
+        r = self.login("pooled@example.com", "secret")
+        self.assertEqual(r.headers["Location"], "/restaurant/")
+
+    def testRejectsWhenQueueIsFull(self):
+        from project.hashing import password_hasher
+
+        self.createUser()
+        rejections = password_hasher.rejections
+
+        # Occupy every queue slot
+        password_hasher._slots.acquire()
+        password_hasher._slots.acquire()
+        try:
+            r = self.login()
+        finally:
+            password_hasher._slots.release()
+            password_hasher._slots.release()
+
+        self.assertEqual(r.status_code, 503)
+        self.assertEqual(password_hasher.rejections, rejections + 1)
+        self.assertEqual(self.login().status_code, 302)
+
+    def testTimedOutHashKeepsItsSlot(self):
+        import time
+        from project.hashing import password_hasher, HashingBusy
+
+        password_hasher.timeout = 0.01
+        try:
+            self.assertRaises(HashingBusy, password_hasher._run, time.sleep, 1)
+        finally:
+            password_hasher.timeout = self.app.config['PASSWORD_HASH_TIMEOUT']
+
+        # The sleep is still running and holds one of the two slots
+        self.assertTrue(password_hasher._slots.acquire(blocking=False))
+        self.assertFalse(password_hasher._slots.acquire(blocking=False))
+        password_hasher._slots.release()
+
+        deadline = time.monotonic() + 30
+        while not password_hasher._slots.acquire(blocking=False):
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.05)
+        password_hasher._slots.release()
+
+
+class RateLimitTestCases(AppTestCase):
+
+    def appConfig(self):
+        return dict(super().appConfig(), RATELIMIT_ACCOUNT_BURST=3, RATELIMIT_IP_BURST=5)
+
+    def testAccountLimitRejectsBeforeAnyWork(self):
+        self.createUser()
+        for _ in range(3):
+            self.assertEqual(self.login(password="wrong").status_code, 302)
+
+        selects = self.countStatements("SELECT")
+        r = self.login()
+        self.assertEqual(r.status_code, 429)
+        self.assertGreater(int(r.headers["Retry-After"]), 0)
+        self.assertEqual(selects, [])
+
+        # The account limit is per account, signing up as someone else still works
+        self.assertEqual(self.client.post("/signup/", data={"email": "other@example.com"}).status_code, 302)
+
+    def testIPLimitCoversEveryAccount(self):
+        for n in range(5):
+            self.login(email=f"user{n}@example.com")
+        self.assertEqual(self.login(email="fresh@example.com").status_code, 429)
+        self.assertEqual(self.client.get("/login/").status_code, 200)
+
+    def testBucketsRefill(self):
+        from project.ratelimit import MemoryBuckets
+
+        buckets = MemoryBuckets()
+        self.assertEqual([buckets.take("k", 2, 0.5, 100) for _ in range(3)], [0, 0, 2])
+        self.assertEqual(buckets.take("k", 2, 0.5, 102), 0)
+        self.assertEqual(buckets.take("k", 2, 0.5, 102), 2)
+
+    def testSQLiteBucketsAreShared(self):
+        import os
+        from project.ratelimit import SQLiteBuckets
+
+        path = os.path.join(self.tmpdir.name, "ratelimit.sqlite")
+        first, second = SQLiteBuckets(path, cleanup_interval=2), SQLiteBuckets(path, cleanup_interval=2)
+        self.assertEqual(first.take("k", 2, 0.5, 100), 0)
+        self.assertEqual(second.take("k", 2, 0.5, 100), 0)
+        self.assertEqual(first.take("k", 2, 0.5, 100), 2)
+        # Buckets that have refilled are cleaned up
+        self.assertEqual(second.take("other", 2, 0.5, 200), 0)
+        rows = first._connection().execute("SELECT key FROM bucket").fetchall()
+        self.assertEqual(rows, [("other",)])
+
+
+class InvalidationBusTestCases(AppTestCase):
+    """The app as one worker of a pre-fork server, with a second bus standing in for another worker"""
+
+    def appConfig(self):
+        import os
+
+        return dict(super().appConfig(), INVALIDATION_BUS=os.path.join(self.tmpdir.name, "bus.sqlite"))
+
+    def otherWorker(self):
+        from project.bus import InvalidationBus
+
+        bus = InvalidationBus()
+        bus.configure(self.app.config["INVALIDATION_BUS"], retention=self.app.config["INVALIDATION_BUS_RETENTION"])
+        return bus
+
+    def testLogoutInOtherWorker(self):
+        from sqlalchemy import text
+        from project import db
+        from project.sessions import token_digest
+
+        self.createUser()
+        self.login()
+        self.assertIn("tester", self.client.get("/restaurant/").text)
+
+        with self.client.session_transaction() as session:
+            token = session["token"]
+        with self.app.app_context():
+            db.session.execute(text("DELETE FROM user_token"))
+            db.session.commit()
+        self.otherWorker().publish("session", token_digest(token))
+
+        self.assertNotIn("tester", self.client.get("/restaurant/").text)
+
+    def testTokensAreNotPublished(self):
+        import sqlite3
+        from project.sessions import token_digest
+
+        self.createUser()
+        self.login()
+        with self.client.session_transaction() as session:
+            token = session["token"]
+        self.client.post("/logout/")
+
+        with sqlite3.connect(self.app.config["INVALIDATION_BUS"]) as connection:
+            messages = connection.execute("SELECT args FROM message WHERE kind = 'session'").fetchall()
+        self.assertEqual(messages, [(f'["{token_digest(token)}"]',)])
+
+    def testChangesInOtherWorker(self):
+        from sqlalchemy import text
+        from project import db
+
+        restaurant_id = self.createRestaurant("Before")
+        etag = self.client.get("/restaurant/JSON").headers["ETag"]
+        self.assertIn("Before", self.client.get("/restaurant/").text)
+
+        with self.app.app_context():
+            db.session.execute(text("UPDATE restaurant SET name = 'After'"))
+            db.session.commit()
+        other = self.otherWorker()
+        message_id = other.publish("restaurant", restaurant_id)
+        other.publish("restaurants")
+
+        self.assertIn("After", self.client.get("/restaurant/").text)
+        r = self.client.get("/restaurant/JSON", headers={"If-None-Match": etag})
+        self.assertEqual(r.status_code, 200)
+        # Versions are bus message ids, so every worker tags a resource alike
+        self.assertEqual(self.client.get(f"/restaurant/{restaurant_id}/menu/JSON").headers["ETag"],
+                         f'"{other.nonce}-{message_id}"')
+
+    def testOwnChangesArePublished(self):
+        restaurant_id = self.createRestaurant()
+        received = []
+        other = self.otherWorker()
+        other.subscribe("restaurant", received.append)
+
+        from project.main import restaurant_changed
+        with self.app.app_context():
+            restaurant_changed(restaurant_id)
+        other.poll()
+        self.assertEqual(received, [restaurant_id])
+
+    def testMissedMessagesClearCaches(self):
+        from project.main import page_cache
+
+        self.app.config["INVALIDATION_BUS_RETENTION"] = 10
+        self.client.get("/restaurant/")
+        self.assertEqual(page_cache.stats()["size"], 1)
+
+        other = self.otherWorker()
+        for _ in range(200):
+            other.publish("qr", 0)
+
+        self.client.get("/restaurant/JSON")
+        self.assertEqual(page_cache.stats()["size"], 0)
+
+
+class TOTPSetupTestCases(AppTestCase):
+
+    def testQRCodeIsCachedUntilSecretChanges(self):
+        from unittest import mock
+        import pyqrcode
+
+        self.createUser()
+        self.login()
+        self.client.post("/totp/")
+
+        with mock.patch("pyqrcode.create", wraps=pyqrcode.create) as create:
+            first = self.client.get("/totp/").text
+            second = self.client.get("/totp/").text
+        self.assertEqual(create.call_count, 1)
+        self.assertEqual(first, second)
+        self.assertIn("<svg", first)
+        self.assertNotIn("b'<svg", first)
+
+        # A failed verification removes the secret, a new one gets a new code
+        self.client.post("/totp/verify/", data={"code": "000000"})
+        self.client.post("/totp/")
+        with mock.patch("pyqrcode.create", wraps=pyqrcode.create) as create:
+            third = self.client.get("/totp/").text
+        self.assertEqual(create.call_count, 1)
+        self.assertNotEqual(first, third)
+
+
+class MetricsTestCases(AppTestCase):
+
+    def setUp(self):
+        from project.metrics import registry
+
+        registry.clear()
+        super().setUp()
+
+    def appConfig(self):
+        import os
+
+        self.profile_dir = os.path.join(self.tmpdir.name, "profiles")
+        return dict(super().appConfig(), METRICS_ENABLED=True, METRICS_PROFILE_THRESHOLD=0,
+                    METRICS_PROFILE_DIR=self.profile_dir)
+
+    def sample(self, text, series):
+        """Returns the value of one series from the Prometheus text format"""
+        for line in text.splitlines():
+            name, _, value = line.rpartition(" ")
+            if name == series:
+                return float(value)
+        self.fail(f"{series} not found")
+
+    def testRequestsAreRecorded(self):
+        import os
+
+        restaurant_id = self.createRestaurant()
+        self.client.get(f"/restaurant/{restaurant_id}/menu/")
+        self.client.get(f"/restaurant/{restaurant_id}/menu/JSON").close()
+
+        metrics = self.client.get("/metrics").text
+        self.assertIn('restaurant_request_duration_seconds_count{endpoint="main.showMenu"} 1', metrics)
+        self.assertIn('restaurant_request_duration_seconds_count{endpoint="json.restaurantMenuJSON"} 1', metrics)
+        self.assertIn('restaurant_cache_misses_total{cache="page"}', metrics)
+        self.assertIn('restaurant_session_resolutions_total', metrics)
+
+        self.assertGreater(self.sample(metrics, 'restaurant_sql_statements_total{endpoint="main.showMenu"}'), 0)
+        self.assertGreater(self.sample(metrics, 'restaurant_template_seconds_total{endpoint="main.showMenu"}'), 0)
+
+        # Every request took longer than the zero threshold, so each left a profile
+        self.assertTrue(any(name.startswith("main.showMenu-") for name in os.listdir(self.profile_dir)))
+
+    def testMetricsAreLocalOnly(self):
+        r = self.client.get("/metrics", environ_base={"REMOTE_ADDR": "203.0.113.7"})
+        self.assertEqual(r.status_code, 404)
+        # Forwarded by a proxy on this machine
+        r = self.client.get("/metrics", headers={"X-Forwarded-For": "203.0.113.7"})
+        self.assertEqual(r.status_code, 404)
+        self.assertEqual(self.client.get("/metrics").status_code, 200)
+
+    def testMetricsToken(self):
+        from project import create_app
+
+        client = create_app(dict(self.appConfig(), METRICS_TOKEN="s3cret")).test_client()
+        proxied = {"X-Forwarded-For": "203.0.113.7"}
+        self.assertEqual(client.get("/metrics", headers=proxied).status_code, 404)
+        self.assertEqual(client.get("/metrics", headers=dict(proxied, Authorization="Bearer wrong")).status_code, 404)
+        self.assertEqual(client.get("/metrics", headers=dict(proxied, Authorization="Bearer s3cret")).status_code, 200)
+
+    def testDisabledByDefault(self):
+        from project import create_app
+
+        app = create_app(AppTestCase.appConfig(self))
+        self.assertEqual(app.test_client().get("/metrics").status_code, 404)
+
+
+class StartupTestCases(AppTestCase):
+
+    def testPrecompiledTemplatesAreNotCompiledAgain(self):
+        import os
+        from unittest import mock
+        from jinja2 import Environment
+        from project import create_app
+
+        result = self.app.test_cli_runner().invoke(args=["precompile-templates"])
+        self.assertIn(f"Compiled {len(self.app.jinja_env.list_templates())} templates.", result.output)
+        self.assertTrue(os.listdir(self.appConfig()['TEMPLATE_BYTECODE_CACHE']))
+
+        # A new server process loads the compiled templates from the cache
+        app = create_app(self.appConfig())
+        with mock.patch.object(Environment, "compile", wraps=app.jinja_env.compile) as compile:
+            self.assertEqual(app.test_client().get("/restaurant/").status_code, 200)
+        compile.assert_not_called()
+
+    def testChangedTemplatesAreCompiledAgain(self):
+        from unittest import mock
+        from jinja2 import Environment
+        from project import create_app
+
+        self.app.test_cli_runner().invoke(args=["precompile-templates"])
+
+        app = create_app(self.appConfig())
+        get_source = app.jinja_env.loader.get_source
+
+        def changed_source(environment, name):
+            source, filename, uptodate = get_source(environment, name)
+            if name == "restaurants.html":
+                source = source.replace("<h1>Restaurants</h1>", "<h1>All Restaurants</h1>")
+            return source, filename, uptodate
+
+        with mock.patch.object(app.jinja_env.loader, "get_source", changed_source), \
+                mock.patch.object(Environment, "compile", wraps=app.jinja_env.compile) as compile:
+            self.assertIn("<h1>All Restaurants</h1>", app.test_client().get("/restaurant/").text)
+        self.assertTrue(compile.called)
+
+    def testTwoFactorLibrariesAreImportedOnFirstUse(self):
+        import subprocess
+        import sys
+
+        code = "import sys, project.main; print(sorted({'pyotp', 'pyqrcode'} & set(sys.modules)))"
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+        self.assertEqual(output.strip(), "[]")